@@ -0,0 +1,48 @@
+from typing import *
+
+import cv2 as cv
+import numpy as np
+import torch
+import torchvision.transforms
+from PIL import Image
+
+
+# Region scores of a batch of equally sized images, as uint8 maps with the same size as the images
+@torch.no_grad()
+def region_scores(model, images: List[Image.Image]) -> List[np.ndarray]:
+    batch = torch.stack([torchvision.transforms.ToTensor()(image.convert('RGB')) for image in images])
+    scores, _ = model(batch.to(model.device))
+    scores = (scores.squeeze(1).clamp(0, 1) * 255).to(torch.uint8).cpu().numpy()
+    width, height = images[0].size
+    return [cv.resize(score, (width, height), interpolation=cv.INTER_LINEAR) for score in scores]
+
+
+# Removes specks smaller than the kernel from a region score
+def open_region_score(region_score: np.ndarray) -> np.ndarray:
+    kernel = np.ones((5, 5), np.uint8)
+    return cv.morphologyEx(region_score, cv.MORPH_OPEN, kernel, iterations=1)
+
+
+# Bounding boxes (x, y, w, h) of the characters in a region score, in reading order
+def boxes_from_region_score(region_score: np.ndarray, threshold: int = 64, expand: int = 2) \
+        -> List[Tuple[int, int, int, int]]:
+    _, thresh = cv.threshold(open_region_score(region_score), threshold, 255, 0)
+    contours, _ = cv.findContours(thresh, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
+
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv.boundingRect(contour)
+        boxes.append((x - expand, y - expand, w + expand * 2, h + expand * 2))
+    # The localized text is a horizontal line, so left to right is reading order
+    return sorted(boxes, key=lambda box: box[0])
+
+
+# A size x size crop centered on the box, padded with white where it extends past the image
+def crop_around(image: Image.Image, box: Tuple[int, int, int, int], size: int = 128) -> Image.Image:
+    x, y, w, h = box
+    left = x + w // 2 - size // 2
+    top = y + h // 2 - size // 2
+    crop = Image.new('RGB', (size, size), color=(255, 255, 255))
+    crop.paste(image.crop((max(left, 0), max(top, 0), min(left + size, image.width), min(top + size, image.height))),
+               (max(-left, 0), max(-top, 0)))
+    return crop
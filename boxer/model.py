@@ -6,6 +6,7 @@ import wandb
 
 from boxer.craft import CRAFT
 from recognizer.data import character_sets
+from recognizer.sample_capture import SampleReservoir, AsyncLogger
 
 
 class KanjiBoxer(pl.LightningModule):
@@ -25,6 +26,10 @@ class KanjiBoxer(pl.LightningModule):
         self.val_accuracy = pl.metrics.Accuracy()
         self.test_accuracy = pl.metrics.Accuracy()
 
+        # Samples seen during the epoch, logged at the end of it
+        self.samples = SampleReservoir(size=8)
+        self.sample_logger = AsyncLogger()
+
     def forward(self, x):
         return self.model(x)
 
@@ -35,24 +40,26 @@ class KanjiBoxer(pl.LightningModule):
         images, character_index, region_score = batch
         generated_region_score, _ = self(images)
         loss = F.mse_loss(generated_region_score, region_score)
+        self.samples.add(images, region_score, generated_region_score)
 
         self.log('train/loss', loss)
 
         return loss
 
     def training_epoch_end(self, *args):
-        images, character_index, region_scores = next(iter(self.train_dataloader()))
-        generated_region_scores, _ = self(images)
-        self.log('train/images', [wandb.Image(x) for x in images[:8]])
-        self.log('train/region_scores', [wandb.Image(x) for x in
-            region_scores[:8]])
-        self.log('train/generated_region_scores', [wandb.Image(x) for x in
-            generated_region_scores[:8]])
+        samples = self.samples.take()
+        if samples:
+            self.sample_logger.submit(log_region_scores, self.logger.experiment, samples)
        # iwandb.log({"train/failure_cases": [wandb.Image(
        #          case["image"],
        #          caption=f"Prediction: {case['prediction']} Truth: {case['label']}"
        #      ) for case in sorted(failure_cases, key=lambda item: item['confidence'])[:1]]}, commit=False)
 
-        dataset = self.train_dataloader().dataset
-        dataset.stage += 0.1
-        self.log('train/stage', dataset.stage, prog_bar=True)
+
+def log_region_scores(experiment, samples):
+    images, region_scores, generated_region_scores = zip(*samples)
+    experiment.log({
+        'train/images': [wandb.Image(x) for x in images],
+        'train/region_scores': [wandb.Image(x) for x in region_scores],
+        'train/generated_region_scores': [wandb.Image(x) for x in generated_region_scores],
+    })
@@ -14,6 +14,7 @@ import torchvision.transforms
 import pytorch_lightning as plt
 from pytorch_lightning.loggers import WandbLogger
 
+from boxer.localize import region_scores, open_region_score, boxes_from_region_score
 from boxer.model import KanjiBoxer
 from recognizer.data.data_module import RecognizerDataModule
 
@@ -26,6 +27,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     model = KanjiBoxer.load_from_checkpoint(args.model_path)
+    model.eval()
 
     paths = glob.glob("/home/martoko/Code/kanji-recognizer/data/free-kanji/*/1.png")
     print(paths)
@@ -35,34 +37,13 @@ if __name__ == "__main__":
         outpath3 = os.path.splitext(p)[0] + "_gen3" + os.path.splitext(p)[1]
         image = PIL.Image.open(p).convert('RGB')
         # image = PIL.ImageChops.offset(image, xoffset=-10, yoffset=-10)
-        i = torchvision.transforms.ToTensor()(image).unsqueeze(0)
-        print(i.shape)
-        o, _ = model(i)
-        o = o.squeeze(0).repeat(3, 1, 1).clamp(0, 1)
-        print(o.shape)
-        po = torchvision.transforms.ToPILImage()(o).resize((128, 128))
-        po.save(outpath)
-
-        cvo = np.array(po)[:, :, :1].copy()
-
-        kernel = np.ones((5, 5), np.uint8)
-        # erosion = cv.erode(cvo, kernel, iterations=1)
-        opened = cv.morphologyEx(cvo, cv.MORPH_OPEN, kernel, iterations=1)
+        region_score = region_scores(model, [image])[0]
+        cv.imwrite(outpath, region_score)
 
         # erode/dilate/opening/closing.
-        cv.imwrite(outpath2, opened)
+        cv.imwrite(outpath2, open_region_score(region_score))
 
-        ret, thresh = cv.threshold(opened, 64, 255, 0)
-        print(thresh.dtype)
-        print(thresh.shape)
-        contours, hierarchy = cv.findContours(thresh, 1, 2)
-        cnt = contours[0]
-        x, y, w, h = cv.boundingRect(cnt)
-        expand = 2
-        x -= expand
-        y -= expand
-        w += expand * 2
-        h += expand * 2
         cvi = cv.imread(p)
-        lbelled = cv.rectangle(cvi, (x, y), (x + w, y + h), (0, 255, 0), 1)
-        cv.imwrite(outpath3, lbelled)
+        for x, y, w, h in boxes_from_region_score(region_score):
+            cvi = cv.rectangle(cvi, (x, y), (x + w, y + h), (0, 255, 0), 1)
+        cv.imwrite(outpath3, cvi)
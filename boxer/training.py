@@ -4,6 +4,7 @@ import pytorch_lightning as pl
 from pytorch_lightning.loggers import WandbLogger
 
 from boxer.model import KanjiBoxer
+from recognizer.data.curriculum import Curriculum
 from recognizer.data.data_module import RecognizerDataModule
 
 if __name__ == "__main__":
@@ -19,7 +20,6 @@ if __name__ == "__main__":
 
     datamodule = RecognizerDataModule(**args)
     datamodule.setup()
-    datamodule.train.stage = 3
     trainer = pl.Trainer(
       limit_train_batches=3 * args["accumulate_grad_batches"],
       val_check_interval=3 * args["accumulate_grad_batches"],
@@ -27,7 +27,8 @@ if __name__ == "__main__":
       stochastic_weight_avg=True,
       accumulate_grad_batches=args["accumulate_grad_batches"],
       gpus=0,
-      logger=WandbLogger(entity="mb-haag-itu", log_model=True, project="kanji-boxer")
+      logger=WandbLogger(entity="mb-haag-itu", log_model=True, project="kanji-boxer"),
+      callbacks=[Curriculum(stage=3, step=0.1, threshold=None)]
     )
     model = KanjiBoxer(**args)
     trainer.fit(model, datamodule=datamodule)
@@ -1,5 +1,7 @@
+import argparse
 import io
 import math
+import os
 import sys
 from typing import *
 
@@ -16,12 +18,16 @@ from PySide6.QtWidgets import (QApplication, QLabel, QPushButton,
 from torchvision.transforms import transforms
 
 # from box_model import KanjiBoxer
+from recognizer import glyph_scale, inference, runtime
 from recognizer.data import character_sets
 from recognizer.model import KanjiRecognizer
+from recognizer.result_cache import RecognitionCache, model_version
 
 
 class Qanji(QWidget):
-    def __init__(self) -> None:
+    # threads are per recognition, or per replica with more than one replica. Replicas each recognize part of the
+    # crops of a grab, on part of the cpus.
+    def __init__(self, threads: Optional[int] = None, cpus: Optional[Set[int]] = None, replicas: int = 1) -> None:
         QWidget.__init__(self)
 
         # This hangs, show nice loading bar
@@ -29,9 +35,29 @@ class Qanji(QWidget):
         # self.boxer = KanjiBoxer(input_dimensions=32)
         # self.boxer.load_state_dict(torch.load('./box_saved_model.pt'))
 
+        # By default a few threads per recognition, at most one per cpu, so running next to training data generation or
+        # other processes does not oversubscribe the cores and make the latency spike
+        cpus = cpus or os.sched_getaffinity(0)
+        if threads is None:
+            threads = max(1, min(4, len(cpus) // replicas))
+        runtime.configure(runtime.RuntimeConfig(intra_op_threads=threads, inter_op_threads=1, cpus=cpus))
+
         self.characters = character_sets.frequent_kanji_plus
         self.recog = KanjiRecognizer.load_from_checkpoint('epoch=260-step=16360.ckpt')
         self.recog.eval()
+        if replicas > 1:
+            self.recog = runtime.ReplicaPool(self.recog, replicas, threads, cpus)
+        # Recognize a batch of shifted and rescaled crops from a larger grab, so off-center cursors and unusual font
+        # sizes are still recognized
+        self.test_time_augmentation = True
+        # Rescale the glyph under the cursor to the size the model was trained on, whatever the size on screen
+        self.normalize_glyph_scale = True
+        # Repeated crops (UI labels, subtitles) are answered from the cache instead of running the model
+        self.recognition_cache = RecognitionCache(
+            f"{model_version('epoch=260-step=16360.ckpt')}:tta={self.test_time_augmentation}"
+            f":scale={self.normalize_glyph_scale}",
+            max_entries=4096
+        )
 
         self.setWindowTitle("Qanji")
 
@@ -62,33 +88,14 @@ class Qanji(QWidget):
 
     @Slot()
     def shoot_screen(self) -> None:
-        self.pixmap = self.clip_around(QCursor.pos(), 128)
+        size = inference.grab_size() if self.test_time_augmentation else 128
+        self.pixmap = self.clip_around(QCursor.pos(), size)
         if self.pixmap is None:
             return
         pilimg = self.pixmap_to_pil(self.pixmap)
 
-        # load data
-        image = pilimg
-        image = np.array(image)
-
-        tensors = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))(
-            transforms.ToTensor()(
-                # np_array
-                pilimg
-            )
-        )
-
-        outputs = self.recog(tensors.reshape(-1, 3, 128, 128))
-        best_confidence, best_indices = torch.sort(outputs, 1, descending=True)
-        # print(best_confidence)
-        # print(best_confidence[0][0])
-        # print(best_indices[0][0])
-        # print(self.characters[best_indices[0][0]])
-        _, predicted = torch.max(outputs, 1)
-        # ocr = self.characters[predicted]
-        # print(ocr)
-        ocr2 = [self.characters[best_indices[0][i]] for i in range(5)]
-        print(ocr2)
+        ocr2 = self.recognize(pilimg)
+        print(ocr2, self.recognition_cache.stats())
         self.text.setText("　".join(ocr2))
 
         im = pilimg.convert("RGB")
@@ -102,6 +109,17 @@ class Qanji(QWidget):
         # )
         self.screenshot_label.setPixmap(scaled_pixmap)
 
+    def recognize(self, image: PIL.Image.Image) -> List[str]:
+        return self.recognition_cache.recognize(image, self.run_recognizer)
+
+    def run_recognizer(self, image: PIL.Image.Image) -> List[str]:
+        if self.normalize_glyph_scale:
+            # Crops of the grab are 128x128, so the glyph size is relative to those
+            image = glyph_scale.normalize_glyph_scale(image, image.width, glyph_size=glyph_scale.GLYPH_FRACTION * 128)
+        if self.test_time_augmentation:
+            return inference.top_k_multi_crop(self.recog, image, self.characters)
+        return inference.top_k(self.recog, [image], self.characters)[0]
+
     @staticmethod
     def clip_around(point: QPoint, size: int) -> Optional[QPixmap]:
         screen = QGuiApplication.screenAt(point)
@@ -151,9 +169,17 @@ class Qanji(QWidget):
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-
-    widget = Qanji()
+    parser = argparse.ArgumentParser(description="Recognize the character under the cursor when shift is pressed.")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="threads per recognition, or per replica with --replicas (default: up to 4)")
+    parser.add_argument("--cpus", type=str, default=None, help="cpus to recognize on, e.g. 0-1 (default: all)")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="recognizer replicas each recognizing part of the crops on part of the cpus (default: 1)")
+    # The remaining arguments are Qt's
+    args, qt_arguments = parser.parse_known_args()
+    app = QApplication(sys.argv[:1] + qt_arguments)
+
+    widget = Qanji(args.threads, runtime.parse_cpus(args.cpus) if args.cpus else None, args.replicas)
     widget.show()
 
     sys.exit(app.exec_())
@@ -0,0 +1,172 @@
+import argparse
+import json
+from collections import Counter
+from typing import *
+
+import torch
+from torch.utils.data import DataLoader
+
+from recognizer.data import validation_dataset
+from recognizer.data.input_format import image_transform, model_input_format
+
+
+class ValidationAnalytics:
+    """Accuracy per class, per translation and the most common confusions of a model on the validation set.
+
+    Only mistakes are counted in the confusion matrix, keyed by (label, prediction), so its size grows with the number
+    of distinct mistakes instead of the square of the number of classes.
+    """
+
+    def __init__(self, characters: List[str]):
+        self.characters = characters
+        self.confusions: Counter = Counter()
+        self.class_totals: Counter = Counter()
+        self.class_correct: Counter = Counter()
+        # Translations are bucketed by their largest coordinate, the Chebyshev distance from the origin
+        self.translation_totals: Counter = Counter()
+        self.translation_correct: Counter = Counter()
+
+    def update(self, labels: torch.Tensor, predictions: torch.Tensor, translations: Tuple[torch.Tensor, torch.Tensor]):
+        distances = torch.max(translations[0].abs(), translations[1].abs())
+        for label, prediction, distance in zip(labels.tolist(), predictions.tolist(), distances.tolist()):
+            self.class_totals[label] += 1
+            self.translation_totals[distance] += 1
+            if label == prediction:
+                self.class_correct[label] += 1
+                self.translation_correct[distance] += 1
+            else:
+                self.confusions[label, prediction] += 1
+
+    @property
+    def accuracy(self) -> float:
+        return sum(self.class_correct.values()) / max(sum(self.class_totals.values()), 1)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "samples": sum(self.class_totals.values()),
+            "accuracy": self.accuracy,
+            "classes": {
+                self.characters[label]: [self.class_correct[label], total]
+                for label, total in sorted(self.class_totals.items())
+            },
+            "translations": {
+                str(distance): [self.translation_correct[distance], total]
+                for distance, total in sorted(self.translation_totals.items())
+            },
+            "confusions": [
+                [self.characters[label], self.characters[prediction], count]
+                for (label, prediction), count in self.confusions.most_common()
+            ],
+        }
+
+
+@torch.no_grad()
+def evaluate(model, dataset, batch_size: int = 64, num_workers: int = 0) -> ValidationAnalytics:
+    analytics = ValidationAnalytics(model.character_set)
+    for images, labels, translations in DataLoader(dataset, batch_size=batch_size, num_workers=num_workers):
+        logits, _ = model.loss(images.to(model.device), labels.to(model.device))
+        analytics.update(labels, torch.argmax(logits, dim=1).cpu(), translations)
+    return analytics
+
+
+def ratio(counts: List[int]) -> float:
+    correct, total = counts
+    return correct / total if total > 0 else 0.0
+
+
+def print_report(report: Dict[str, Any], top: int):
+    print(f"Accuracy: {report['accuracy']:.4f} over {report['samples']} samples")
+
+    print("\nAccuracy by translation:")
+    for distance, counts in report["translations"].items():
+        print(f"  {distance:>3}: {ratio(counts):.4f} ({counts[1]} samples)")
+
+    print(f"\nWorst {top} classes:")
+    worst = sorted(report["classes"].items(), key=lambda item: (ratio(item[1]), -item[1][1]))[:top]
+    for character, counts in worst:
+        print(f"  {character}: {ratio(counts):.4f} ({counts[1]} samples)")
+
+    print(f"\nTop {top} confusions:")
+    for label, prediction, count in report["confusions"][:top]:
+        print(f"  {label} -> {prediction}: {count}")
+
+
+# Changes from one report to another, e.g. between two checkpoints
+def print_comparison(before: Dict[str, Any], after: Dict[str, Any], top: int):
+    print(f"Accuracy: {before['accuracy']:.4f} -> {after['accuracy']:.4f} "
+          f"({after['accuracy'] - before['accuracy']:+.4f})")
+
+    print("\nAccuracy by translation:")
+    for distance in sorted(set(before["translations"]) | set(after["translations"]), key=int):
+        old = ratio(before["translations"].get(distance, [0, 0]))
+        new = ratio(after["translations"].get(distance, [0, 0]))
+        print(f"  {distance:>3}: {old:.4f} -> {new:.4f} ({new - old:+.4f})")
+
+    changes = sorted(
+        (ratio(after["classes"][character]) - ratio(counts), character)
+        for character, counts in before["classes"].items() if character in after["classes"]
+    )
+    print("\nMost regressed classes:")
+    for change, character in changes[:top]:
+        print(f"  {character}: {change:+.4f}")
+    print("\nMost improved classes:")
+    for change, character in reversed(changes[-top:]):
+        print(f"  {character}: {change:+.4f}")
+
+    old_confusions = {(label, prediction): count for label, prediction, count in before["confusions"]}
+    new_confusions = {(label, prediction): count for label, prediction, count in after["confusions"]}
+    confusion_changes = sorted(
+        ((new_confusions.get(pair, 0) - old_confusions.get(pair, 0), pair)
+         for pair in set(old_confusions) | set(new_confusions)),
+        key=lambda item: item[0]
+    )
+    print("\nMost increased confusions:")
+    for change, (label, prediction) in reversed(confusion_changes[-top:]):
+        print(f"  {label} -> {prediction}: {change:+d}")
+    print("\nMost decreased confusions:")
+    for change, (label, prediction) in confusion_changes[:top]:
+        print(f"  {label} -> {prediction}: {change:+d}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Analyse the mistakes of a model on the validation set.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="evaluate a checkpoint and save a report")
+    evaluate_parser.add_argument("-m", "--model-path", type=str, required=True, help="path to a checkpoint")
+    evaluate_parser.add_argument("-o", "--output", type=str, required=True, help="path to save the report to")
+    evaluate_parser.add_argument("--data-folder", type=str, default="data",
+                                 help="path to a folder containing validation data (default: data)")
+    evaluate_parser.add_argument("--batch-size", type=int, default=64)
+    evaluate_parser.add_argument("--num-workers", type=int, default=0)
+    evaluate_parser.add_argument("--top", type=int, default=20)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two saved reports")
+    compare_parser.add_argument("before", type=str)
+    compare_parser.add_argument("after", type=str)
+    compare_parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "evaluate":
+        from recognizer.model import KanjiRecognizer
+
+        model = KanjiRecognizer.load_from_checkpoint(args.model_path)
+        model.eval()
+        dataset = validation_dataset.dataset_from_folder(
+            data_folder=args.data_folder,
+            character_set=model.character_set,
+            # Same transform as RecognizerDataModule
+            transform=image_transform(*model_input_format(model)),
+            return_translation=True
+        )
+        analytics = evaluate(model, dataset, args.batch_size, args.num_workers)
+        report = {"checkpoint": args.model_path, **analytics.to_json()}
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=1)
+        print_report(report, args.top)
+    else:
+        with open(args.before, encoding="utf-8") as file:
+            before = json.load(file)
+        with open(args.after, encoding="utf-8") as file:
+            after = json.load(file)
+        print_comparison(before, after, args.top)
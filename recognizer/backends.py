@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from typing import *
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+
+from recognizer.data.input_format import model_input_format
+
+# Graph optimization levels, by the names of the onnxruntime levels
+OPTIMIZATION_LEVELS = ["disable", "basic", "extended", "all"]
+
+
+class Session:
+    """Runs a model for inference on the cpu, with the calling convention of the model.
+
+    Calling a session with a batch returns what the model would, a tensor or a tuple of tensors, so sessions are drop-in
+    replacements for KanjiRecognizer and KanjiBoxer in recognizer.inference and boxer.localize. The hyperparameters of
+    the model are kept, as the input format is read from them.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, model: nn.Module):
+        self.hparams = getattr(model, 'hparams', {})
+
+    def run(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        raise NotImplementedError()
+
+    def __call__(self, inputs: torch.Tensor):
+        outputs = self.run(inputs.cpu())
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def as_tuple(outputs) -> Tuple[torch.Tensor, ...]:
+    return tuple(outputs) if isinstance(outputs, (tuple, list)) else (outputs,)
+
+
+class TorchSession(Session):
+    """The eager model itself."""
+
+    def __init__(self, model: nn.Module, threads: Optional[int] = None, **kwargs):
+        super().__init__(model)
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = model.cpu().eval()
+
+    @torch.no_grad()
+    def run(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        return as_tuple(self.model(inputs))
+
+
+class TorchScriptSession(Session):
+    """The model traced with TorchScript, frozen and optimized for inference unless optimization is disabled."""
+
+    def __init__(self, model: nn.Module, example: torch.Tensor, threads: Optional[int] = None,
+                 optimization: str = "all", **kwargs):
+        super().__init__(model)
+        if threads:
+            torch.set_num_threads(threads)
+        with torch.no_grad():
+            self.module = torch.jit.trace(model.cpu().eval(), example, check_trace=False)
+            if optimization != "disable":
+                self.module = torch.jit.optimize_for_inference(torch.jit.freeze(self.module))
+
+    @torch.no_grad()
+    def run(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        return as_tuple(self.module(inputs))
+
+
+class OnnxRuntimeSession(Session):
+    """The model exported to ONNX and run by the onnxruntime cpu execution provider.
+
+    Exported models are kept next to export_path when given, and reused by later sessions, as exporting a resnet152
+    takes a while. The file name includes a hash of the weights, so a changed model is exported again.
+    """
+
+    def __init__(self, model: nn.Module, example: torch.Tensor, threads: Optional[int] = None,
+                 optimization: str = "all", export_path: Optional[str] = None, dynamic_size: bool = False, **kwargs):
+        super().__init__(model)
+        # Only needed by this backend
+        import onnxruntime
+
+        if export_path is None:
+            export_path = os.path.join(tempfile.mkdtemp(), "model.onnx")
+        export_path = exported_path(export_path, model, example, dynamic_size)
+        if not os.path.exists(export_path):
+            export_onnx(model, example, export_path, dynamic_size)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = {
+            "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[optimization]
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(export_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        outputs = self.session.run(None, {self.input_name: inputs.numpy()})
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+
+# Hash of everything an export depends on: the weights and buffers of the model and the input it is traced with
+def export_hash(model: nn.Module, example: torch.Tensor, dynamic_size: bool) -> str:
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(repr((tuple(example.shape), dynamic_size)).encode())
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+# The path a model is exported to, e.g. model-0123456789abcdef.onnx for model.onnx
+def exported_path(export_path: str, model: nn.Module, example: torch.Tensor, dynamic_size: bool = False) -> str:
+    root, extension = os.path.splitext(export_path)
+    return f"{root}-{export_hash(model, example, dynamic_size)}{extension}"
+
+
+# Exports with a dynamic batch size, so the session takes batches of any size. With dynamic_size the height and width of
+# the images and of the outputs are dynamic too, as for the region scores of the boxer.
+def export_onnx(model: nn.Module, example: torch.Tensor, path: str, dynamic_size: bool = False):
+    model = model.cpu().eval()
+    with torch.no_grad():
+        outputs = as_tuple(model(example))
+    output_names = [f"output{i}" for i in range(len(outputs))]
+    axes = {0: "batch", 2: "height", 3: "width"} if dynamic_size else {0: "batch"}
+    # Written next to the path first, so an interrupted export is not reused
+    partial_path = path + ".partial"
+    torch.onnx.export(
+        model, example, partial_path,
+        input_names=["input"],
+        output_names=output_names,
+        dynamic_axes={
+            name: {axis: label for axis, label in axes.items() if axis < len(shape)}
+            for name, shape in zip(["input"] + output_names, [example.shape] + [output.shape for output in outputs])
+        },
+        opset_version=13
+    )
+    os.replace(partial_path, path)
+
+
+BACKENDS = {
+    "torch": TorchSession,
+    "torchscript": TorchScriptSession,
+    "onnxruntime": OnnxRuntimeSession,
+}
+
+
+def available_backends() -> List[str]:
+    return [
+        name for name in BACKENDS
+        if name != "onnxruntime" or importlib.util.find_spec("onnxruntime") is not None
+    ]
+
+
+# The backend to use in production, the first available of the fastest on the cpu
+def fastest_backend() -> str:
+    for name in ["onnxruntime", "torchscript", "torch"]:
+        if name in available_backends():
+            return name
+
+
+# Creates a session from a config, e.g. {"backend": "onnxruntime", "threads": 4, "optimization": "all"}. Inputs are
+# batches of input_shape, which is (channels, height, width), or of any height and width with dynamic_size.
+def create_session(model: nn.Module, input_shape: Sequence[int] = (3, 128, 128), backend: Optional[str] = None,
+                   threads: Optional[int] = None, optimization: str = "all",
+                   export_path: Optional[str] = None, dynamic_size: bool = False) -> Session:
+    if backend is None:
+        backend = fastest_backend()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if optimization not in OPTIMIZATION_LEVELS:
+        raise ValueError(f"Unknown optimization level: {optimization}")
+    example = torch.zeros(1, *input_shape)
+    return BACKENDS[backend](model, example=example, threads=threads, optimization=optimization,
+                             export_path=export_path, dynamic_size=dynamic_size)
+
+
+def recognizer_session(model, **config) -> Session:
+    input_size, channels = model_input_format(model)
+    return create_session(model, (channels, input_size, input_size), **config)
+
+
+# Exports a recognizer once, for onnxruntime sessions created later with the same export_path, e.g. in forked replicas
+def export_recognizer(model, export_path: str):
+    input_size, channels = model_input_format(model)
+    example = torch.zeros(1, channels, input_size, input_size)
+    path = exported_path(export_path, model, example)
+    if not os.path.exists(path):
+        export_onnx(model, example, path)
+
+
+# Frames of any size go through the boxer
+def boxer_session(model, **config) -> Session:
+    return create_session(model, (3, 128, 128), dynamic_size=True, **config)
+
+
+def predict(session: Session, dataset, batch_size: int) -> Tuple[torch.Tensor, float]:
+    outputs = []
+    seconds = 0
+    for images, _ in DataLoader(dataset, batch_size=batch_size):
+        start = time.perf_counter()
+        outputs.append(session(images))
+        seconds += time.perf_counter() - start
+    return torch.cat(outputs), seconds
+
+
+# How closely the outputs of a backend follow those of eager torch on the same samples
+def agreement(outputs: torch.Tensor, reference: torch.Tensor, k: int = 5) -> Dict[str, float]:
+    top_k = torch.topk(outputs, k, dim=1).indices
+    reference_top_k = torch.topk(reference, k, dim=1).indices
+    return {
+        "max_difference": (outputs - reference).abs().max().item(),
+        "top_1_agreement": (top_k[:, 0] == reference_top_k[:, 0]).float().mean().item(),
+        "top_k_agreement": (top_k == reference_top_k).all(dim=1).float().mean().item(),
+    }
+
+
+# A backend is at parity when its outputs are within the tolerance and its top 1 predictions are all the same
+def at_parity(result: Dict[str, float], tolerance: float = 1e-3) -> bool:
+    return result["max_difference"] <= tolerance and result["top_1_agreement"] == 1
+
+
+if __name__ == '__main__':
+    from recognizer import inference
+    from recognizer.data import validation_dataset
+    from recognizer.model import KanjiRecognizer
+
+    parser = argparse.ArgumentParser(
+        description="Compare the top k predictions of the backends on the free-kanji validation images.")
+    parser.add_argument("-m", "--model-path", type=str, required=True, help="path to a checkpoint")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing validation data (default: data)")
+    parser.add_argument("--backends", type=str, nargs="+", default=available_backends(), choices=BACKENDS.keys(),
+                        help="backends to compare with eager torch (default: all available)")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--optimization", type=str, default="all", choices=OPTIMIZATION_LEVELS)
+    parser.add_argument("--samples", type=int, default=1000, help="validation samples to compare (default: 1000)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="largest allowed difference of the outputs from eager torch (default: 1e-3)")
+    args = parser.parse_args()
+
+    model = KanjiRecognizer.load_from_checkpoint(args.model_path)
+    dataset = validation_dataset.dataset_from_folder(
+        data_folder=args.data_folder,
+        character_set=model.character_set,
+        # Same transform as recognizer.inference
+        transform=inference.to_tensor(*model_input_format(model))
+    )
+    dataset = Subset(dataset, np.linspace(0, len(dataset) - 1, min(args.samples, len(dataset))).astype(int).tolist())
+
+    reference, reference_seconds = predict(TorchSession(model, args.threads), dataset, args.batch_size)
+    print(f"torch: {len(dataset) / reference_seconds:.1f} samples/s")
+
+    failed = False
+    for backend in args.backends:
+        if backend == "torch":
+            continue
+        session = recognizer_session(model, backend=backend, threads=args.threads, optimization=args.optimization)
+        outputs, seconds = predict(session, dataset, args.batch_size)
+        result = agreement(outputs, reference, args.k)
+        print(f"{backend}: {len(dataset) / seconds:.1f} samples/s, max difference {result['max_difference']:.2e}, "
+              f"top 1 agreement {result['top_1_agreement']:.4f}, "
+              f"top {args.k} agreement {result['top_k_agreement']:.4f}")
+        failed |= not at_parity(result, args.tolerance)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import *
+
+import numpy as np
+from PIL import Image
+
+from recognizer import inference
+
+
+class BatchingScheduler:
+    """Recognizes the crops of concurrent callers together, in one forward pass per batch.
+
+    Pending crops are collected for up to `max_wait` seconds after the first one arrives, or until there are
+    `max_batch_size` of them, then recognized in a single batch and the top k characters of every crop are handed back
+    through its future. The model can also be a recognizer.backends session or a recognizer.runtime.ReplicaPool.
+    """
+
+    def __init__(self, model, characters: List[str], k: int = 5, max_batch_size: int = 32, max_wait: float = 0.005):
+        self.model = model
+        self.characters = characters
+        self.k = k
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.crops = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image: Image.Image) -> Future:
+        future = Future()
+        self.queue.put((image, future, time.monotonic()))
+        return future
+
+    def recognize(self, image: Image.Image) -> List[str]:
+        return self.submit(image).result()
+
+    async def recognize_async(self, image: Image.Image) -> List[str]:
+        return await asyncio.wrap_future(self.submit(image))
+
+    # Requests cancelled by their caller while waiting are left out, the others can no longer be cancelled. The wait
+    # counts from the submission of the first request, which may have waited for the previous batch already.
+    def next_batch(self) -> Optional[List[Tuple[Image.Image, Future]]]:
+        batch = []
+        while not batch:
+            request = self.queue.get()
+            if request is None:
+                return None
+            if request[1].set_running_or_notify_cancel():
+                batch.append(request[:2])
+        deadline = request[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Finish this batch before stopping
+                self.queue.put(None)
+                break
+            if request[1].set_running_or_notify_cancel():
+                batch.append(request[:2])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            images, futures = zip(*batch)
+            try:
+                results = inference.top_k(self.model, list(images), self.characters, self.k)
+            except Exception as exception:
+                for future in futures:
+                    try:
+                        future.set_exception(exception)
+                    except InvalidStateError:
+                        pass
+                continue
+            for future, result in zip(futures, results):
+                try:
+                    future.set_result(result)
+                except InvalidStateError:
+                    # Already resolved, which must not stop the scheduler
+                    pass
+            self.batches += 1
+            self.crops += len(batch)
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.crops / self.batches if self.batches > 0 else 0.0
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+# Clients each recognize crops one after another, the latency of a crop includes its time waiting for a batch
+def benchmark(recognize: Callable[[Image.Image], List[str]], image: Image.Image, clients: int,
+              requests: int) -> Dict[str, float]:
+    latencies = []
+    lock = threading.Lock()
+
+    def client(count: int):
+        for _ in range(count):
+            start = time.perf_counter()
+            recognize(image)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(requests // clients,)) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "crops_per_second": len(latencies) / seconds,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+if __name__ == '__main__':
+    from recognizer.model import KanjiRecognizer
+
+    parser = argparse.ArgumentParser(description="Compare batched and unbatched recognition of concurrent clients.")
+    parser.add_argument("-m", "--model-path", type=str, required=True, help="path to a checkpoint")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="concurrent clients to measure (default: 1 4 16 64)")
+    parser.add_argument("--requests", type=int, default=256, help="crops per measurement (default: 256)")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait", type=float, default=5, help="milliseconds to wait for a batch (default: 5)")
+    args = parser.parse_args()
+
+    model = KanjiRecognizer.load_from_checkpoint(args.model_path)
+    model.eval()
+    image = Image.new('RGB', (128, 128), (255, 255, 255))
+    scheduler = BatchingScheduler(model, model.character_set, max_batch_size=args.max_batch_size,
+                                  max_wait=args.max_wait / 1000)
+    unbatched_lock = threading.Lock()
+
+    def recognize_unbatched(crop: Image.Image) -> List[str]:
+        # One forward pass at a time, as when every caller runs the model itself
+        with unbatched_lock:
+            return inference.top_k(model, [crop], model.character_set)[0]
+
+    for clients in args.clients:
+        for name, recognize in [("unbatched", recognize_unbatched), ("batched", scheduler.recognize)]:
+            result = benchmark(recognize, image, clients, max(args.requests, clients))
+            print(f"{clients} clients, {name}: {result['crops_per_second']:.1f} crops/s, "
+                  f"p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms")
+        print(f"Mean batch size: {scheduler.mean_batch_size:.1f}")
+    scheduler.close()
@@ -0,0 +1,56 @@
+from typing import *
+
+import torch
+from torch import nn
+from torchvision.models.resnet import Bottleneck
+
+
+def bottlenecks(model: nn.Module) -> List[Bottleneck]:
+    return [module for module in model.modules() if isinstance(module, Bottleneck)]
+
+
+# Widths of the two inner convolutions of every bottleneck block, stored in the hyperparameters of pruned checkpoints
+def bottleneck_widths(model: nn.Module) -> List[Tuple[int, int]]:
+    return [(block.conv1.out_channels, block.conv2.out_channels) for block in bottlenecks(model)]
+
+
+def index_batch_norm(batch_norm: nn.BatchNorm2d, keep: torch.Tensor) -> nn.BatchNorm2d:
+    result = nn.BatchNorm2d(len(keep), eps=batch_norm.eps, momentum=batch_norm.momentum)
+    result.weight.data = batch_norm.weight.data[keep].clone()
+    result.bias.data = batch_norm.bias.data[keep].clone()
+    result.running_mean = batch_norm.running_mean[keep].clone()
+    result.running_var = batch_norm.running_var[keep].clone()
+    result.num_batches_tracked = batch_norm.num_batches_tracked.clone()
+    return result
+
+
+def index_conv(conv: nn.Conv2d, keep_out: Optional[torch.Tensor] = None,
+               keep_in: Optional[torch.Tensor] = None) -> nn.Conv2d:
+    weight = conv.weight.data
+    if keep_out is not None:
+        weight = weight[keep_out]
+    if keep_in is not None:
+        weight = weight[:, keep_in]
+    result = nn.Conv2d(weight.shape[1], weight.shape[0], conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                       dilation=conv.dilation, bias=False)
+    result.weight.data = weight.clone()
+    return result
+
+
+# Keeps the given channels of the two inner convolutions of a bottleneck, the input and output of the block, and so the
+# residual connections, are unchanged
+def prune_bottleneck(block: Bottleneck, keep1: torch.Tensor, keep2: torch.Tensor):
+    block.conv1 = index_conv(block.conv1, keep_out=keep1)
+    block.bn1 = index_batch_norm(block.bn1, keep1)
+    block.conv2 = index_conv(block.conv2, keep_out=keep2, keep_in=keep1)
+    block.bn2 = index_batch_norm(block.bn2, keep2)
+    block.conv3 = index_conv(block.conv3, keep_in=keep2)
+
+
+# Rebuilds the blocks of a freshly created model with the widths of a pruned one, so its state dict can be loaded
+def resize_bottlenecks(model: nn.Module, widths: Sequence[Sequence[int]]):
+    blocks = bottlenecks(model)
+    if len(blocks) != len(widths):
+        raise ValueError(f"Expected widths for {len(blocks)} bottlenecks, got {len(widths)}")
+    for block, (width1, width2) in zip(blocks, widths):
+        prune_bottleneck(block, torch.arange(width1), torch.arange(width2))
@@ -0,0 +1,130 @@
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import pathlib
+import random
+import resource
+import subprocess
+import time
+
+import numpy as np
+from recognizer.data import character_sets
+from recognizer.data.input_format import image_transform, region_score_transform
+from recognizer.data.profiling import Profiler
+from recognizer.data.training_dataset import RecognizerTrainingDataset
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_worker(dataset, stage, samples, warmup, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    dataset.stage = stage
+    profiler = Profiler()
+    dataset.profiler = profiler
+
+    for _ in range(warmup):
+        dataset.generate()
+    profiler.reset()
+
+    start = time.perf_counter()
+    for _ in range(samples):
+        dataset.generate()
+    seconds = time.perf_counter() - start
+
+    return {"seconds": seconds, "phases": profiler.summary(), "peak_rss_mb": peak_rss_mb()}
+
+
+def benchmark(dataset, stage, samples, workers, warmup):
+    # Measurements always run in forked processes, mirroring how DataLoader workers get their copy of the dataset
+    processes = max(workers, 1)
+    per_process = math.ceil(samples / processes)
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        results = pool.starmap(run_worker, [
+            (dataset, stage, per_process, warmup, seed) for seed in range(processes)
+        ])
+    samples = per_process * processes
+    seconds = max(result["seconds"] for result in results)
+
+    phases = {}
+    for result in results:
+        for name, phase in result["phases"].items():
+            phases[name] = phases.get(name, 0.0) + phase["seconds"]
+
+    return {
+        "samples": samples,
+        "seconds": seconds,
+        "samples_per_second": samples / seconds,
+        "phase_seconds_per_sample": {name: total / samples for name, total in sorted(phases.items())},
+        "peak_rss_mb": max(result["peak_rss_mb"] for result in results),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of the synthetic training data generator.")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing fonts and backgrounds (default: data)")
+    parser.add_argument("--character-set-names", type=str, nargs="+", default=["frequent_kanji_plus"],
+                        choices=character_sets.character_sets.keys(),
+                        help="character sets to benchmark (default: frequent_kanji_plus)")
+    parser.add_argument("--stages", type=int, nargs="+", default=list(range(9)),
+                        help="curriculum stages to benchmark (default: all)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0],
+                        help="worker process counts to benchmark, 0 is a single process (default: 0)")
+    parser.add_argument("--samples", type=int, default=200,
+                        help="samples to generate per measurement (default: 200)")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="samples to generate per worker before measuring (default: 5)")
+    parser.add_argument("--no-transform", action="store_true",
+                        help="measure the PIL output without converting it to tensors")
+    parser.add_argument("--input-size", type=int, default=128, help="input size of the model (default: 128)")
+    parser.add_argument("--channels", type=int, default=3, choices=[1, 3],
+                        help="input channels of the model (default: 3)")
+    parser.add_argument("--output", type=str, default="generated/benchmarks/generation.jsonl",
+                        help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    pathlib.Path(os.path.dirname(args.output)).mkdir(parents=True, exist_ok=True)
+    commit = git_commit()
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+
+    for character_set_name in args.character_set_names:
+        setup_start = time.perf_counter()
+        dataset = RecognizerTrainingDataset(
+            data_folder=args.data_folder,
+            character_set=character_sets.character_sets[character_set_name],
+            transform=None if args.no_transform else image_transform(args.input_size, args.channels),
+            region_score_transform=None if args.no_transform else region_score_transform()
+        )
+        setup_seconds = time.perf_counter() - setup_start
+
+        for stage in args.stages:
+            for workers in args.workers:
+                result = {
+                    "commit": commit,
+                    "timestamp": timestamp,
+                    "character_set_name": character_set_name,
+                    "stage": stage,
+                    "workers": workers,
+                    "setup_seconds": setup_seconds,
+                    **benchmark(dataset, stage, args.samples, workers, args.warmup),
+                }
+                print(f"{character_set_name} stage {stage} workers {workers}: "
+                      f"{result['samples_per_second']:.1f} samples/s, {result['peak_rss_mb']:.0f} MB")
+                with open(args.output, 'a') as file:
+                    file.write(json.dumps(result) + "\n")
@@ -1,62 +1,131 @@
+import hashlib
 import pathlib
+from collections.abc import Mapping
+from functools import cached_property
 from itertools import chain
+from typing import *
+
+# Resolved relative to the package, so importing this module works from any working directory
+CHARACTERS_FOLDER = pathlib.Path(__file__).resolve().parents[2] / "data" / "characters"
 
 
 def characters(ranges):
     return [chr(x) for x in list(chain(*[range(begin, end) for begin, end in ranges]))]
 
 
-hiragana = characters([[0x3041, 0x3096]])
-simple_hiragana = list("あいうえおかきくけこがぎぐげごさしすせそざじずぜぞたちつてとだぢづでどな"
-                       "にぬねのはひふへほばびぶべぼぱぴぷぺぽまみむめもやゆよらりるれろわゐゑを")
-simpler_hiragana = list("あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわを")
-aiueo = list("あいうえおが")
-katakana_full_width = characters([[0x30A0, 0x30FF]])
-kanji = characters([[0x3400, 0x4DB5], [0x4E00, 0x9FCB], [0xF900, 0xFA6A]])
-kanji_radicals = characters([[0x2E80, 0x2FD5]])
-half_width_katakana_and_punctuation = characters([[0xFF5F, 0xFF9F]])
-symbols_and_Punctuation = characters([[0x3000, 0x303F]])
-misc_symbols_and_characters = characters([[0x31F0, 0x31FF], [0x3220, 0x3243], [0x3280, 0x337F]])
-alphanumeric_and_punctuation = characters([[0xFF01, 0xFF5E]])
-all_characters = hiragana + katakana_full_width + kanji + kanji_radicals + \
-                 half_width_katakana_and_punctuation + symbols_and_Punctuation + \
-                 misc_symbols_and_characters + alphanumeric_and_punctuation
-
-jouyou_kanji = list(pathlib.Path("data/characters/jouyou.txt").read_text().replace("\n", ""))
-
-frequent_kanji = list(pathlib.Path("data/characters/frequent_kanji.txt").read_text().replace("\n", ""))
-
-frequent_kanji_plus = list(pathlib.Path("data/characters/frequent_kanji_plus.txt").read_text().replace("\n", ""))
-
-jouyou_kanji_and_simple_hiragana = jouyou_kanji + simple_hiragana
-
-top_100_kanji = frequent_kanji[:100]
-
-character_sets = {
-    "kanji": kanji,  # 27,882
-    "jouyou_kanji": jouyou_kanji,  # 1,006
-    "top_100_kanji": top_100_kanji,  # 100
-    "frequent_kanji": frequent_kanji,  # 2,501
-    "frequent_kanji_plus": frequent_kanji_plus,  # 2,502
-    "jouyou_kanji_and_simple_hiragana": jouyou_kanji_and_simple_hiragana,  # 1,078
-    "simple_hiragana": simple_hiragana,  # 72
-    "simpler_hiragana": simpler_hiragana,  # 45
-    "aiueo": aiueo  # 6
-}
+def characters_from_file(name):
+    return list((CHARACTERS_FOLDER / name).read_text(encoding="utf-8").replace("\n", ""))
+
+
+class CharacterSet(list):
+    """A list of characters with O(1) index lookups and a stable content hash for use in cache keys.
+
+    Character sets are shared between everything using them, so they should not be modified.
+    """
+
+    def __init__(self, characters: Iterable[str]):
+        super().__init__(characters)
+        self.indices: Dict[str, int] = {}
+        for index, character in enumerate(self):
+            self.indices.setdefault(character, index)
+
+    def index(self, character, *args) -> int:
+        if args:
+            return super().index(character, *args)
+        try:
+            return self.indices[character]
+        except KeyError:
+            raise ValueError(f"{character!r} is not in the character set") from None
+
+    def __contains__(self, character) -> bool:
+        return character in self.indices
+
+    @cached_property
+    def content_hash(self) -> str:
+        return hashlib.sha256("".join(self).encode("utf-8")).hexdigest()[:16]
+
+
+class CharacterSetRegistry(Mapping):
+    """Character sets by name, each one is only built the first time it is used."""
+
+    def __init__(self, builders: Dict[str, Callable[[], List[str]]]):
+        self.builders = builders
+        self.built: Dict[str, CharacterSet] = {}
+
+    def __getitem__(self, name: str) -> CharacterSet:
+        if name not in self.built:
+            characters = self.builders[name]()
+            self.built[name] = characters if isinstance(characters, CharacterSet) else CharacterSet(characters)
+        return self.built[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.builders
+
+    def __iter__(self):
+        return iter(self.builders)
+
+    def __len__(self):
+        return len(self.builders)
+
+
+registry = CharacterSetRegistry({
+    "hiragana": lambda: characters([[0x3041, 0x3096]]),
+    "simple_hiragana": lambda: list("あいうえおかきくけこがぎぐげごさしすせそざじずぜぞたちつてとだぢづでどな"
+                                    "にぬねのはひふへほばびぶべぼぱぴぷぺぽまみむめもやゆよらりるれろわゐゑを"),
+    "simpler_hiragana": lambda: list("あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわを"),
+    "aiueo": lambda: list("あいうえおが"),
+    "katakana_full_width": lambda: characters([[0x30A0, 0x30FF]]),
+    "kanji": lambda: characters([[0x3400, 0x4DB5], [0x4E00, 0x9FCB], [0xF900, 0xFA6A]]),
+    "kanji_radicals": lambda: characters([[0x2E80, 0x2FD5]]),
+    "half_width_katakana_and_punctuation": lambda: characters([[0xFF5F, 0xFF9F]]),
+    "symbols_and_Punctuation": lambda: characters([[0x3000, 0x303F]]),
+    "misc_symbols_and_characters": lambda: characters([[0x31F0, 0x31FF], [0x3220, 0x3243], [0x3280, 0x337F]]),
+    "alphanumeric_and_punctuation": lambda: characters([[0xFF01, 0xFF5E]]),
+    "all_characters": lambda: registry["hiragana"] + registry["katakana_full_width"] + registry["kanji"] +
+                              registry["kanji_radicals"] + registry["half_width_katakana_and_punctuation"] +
+                              registry["symbols_and_Punctuation"] + registry["misc_symbols_and_characters"] +
+                              registry["alphanumeric_and_punctuation"],
+    "jouyou_kanji": lambda: characters_from_file("jouyou.txt"),
+    "frequent_kanji": lambda: characters_from_file("frequent_kanji.txt"),
+    "frequent_kanji_plus": lambda: characters_from_file("frequent_kanji_plus.txt"),
+    "jouyou_kanji_and_simple_hiragana": lambda: registry["jouyou_kanji"] + registry["simple_hiragana"],
+    "top_100_kanji": lambda: registry["frequent_kanji"][:100],
+})
+
+# The character sets a model can be trained on
+character_sets = CharacterSetRegistry({
+    "kanji": lambda: registry["kanji"],  # 27,882
+    "jouyou_kanji": lambda: registry["jouyou_kanji"],  # 1,006
+    "top_100_kanji": lambda: registry["top_100_kanji"],  # 100
+    "frequent_kanji": lambda: registry["frequent_kanji"],  # 2,501
+    "frequent_kanji_plus": lambda: registry["frequent_kanji_plus"],  # 2,502
+    "jouyou_kanji_and_simple_hiragana": lambda: registry["jouyou_kanji_and_simple_hiragana"],  # 1,078
+    "simple_hiragana": lambda: registry["simple_hiragana"],  # 72
+    "simpler_hiragana": lambda: registry["simpler_hiragana"],  # 45
+    "aiueo": lambda: registry["aiueo"]  # 6
+})
+
+
+# Makes every character set available as a module attribute, e.g. character_sets.frequent_kanji_plus
+def __getattr__(name):
+    if name in registry:
+        return registry[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
     print("常用漢字")
-    print(jouyou_kanji[:10])
+    print(registry["jouyou_kanji"][:10])
     print()
 
     print("平仮名")
-    print(hiragana[:10])
+    print(registry["hiragana"][:10])
     print()
 
     print("漢字")
-    print(kanji[:10])
+    print(registry["kanji"][:10])
     print()
 
     print("symbols_and_Punctuation")
-    print(symbols_and_Punctuation[:20])
+    print(registry["symbols_and_Punctuation"][:20])
     print()
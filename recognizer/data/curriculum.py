@@ -0,0 +1,54 @@
+from typing import *
+
+import pytorch_lightning as pl
+
+from .training_dataset import STAGES
+
+
+class Curriculum(pl.Callback):
+    """Advances the stage of the training data generator, and keeps the stage in checkpoints so resumed runs continue
+    where they left off.
+
+    At the end of every epoch the stage is advanced by `step` if the `monitor` metric is above `threshold`, or always
+    if `threshold` is None. With `weights`, samples are instead drawn from the stages with fixed weights per stage.
+
+    The stage weights of the dataset are in shared memory, so changes reach the DataLoader workers immediately.
+    """
+
+    def __init__(self, stage: float = 0, step: float = 0.5, monitor: str = 'train/acc_epoch',
+                 threshold: Optional[float] = 0.8, weights: Optional[List[float]] = None):
+        super().__init__()
+        if weights is not None and len(weights) != STAGES:
+            raise ValueError(f"Expected {STAGES} stage weights, got {len(weights)}")
+        self.stage = stage
+        self.step = step
+        self.monitor = monitor
+        self.threshold = threshold
+        self.weights = weights
+
+    def apply(self, dataset):
+        if self.weights is not None:
+            dataset.stage_weights[:] = self.weights
+        else:
+            dataset.stage = self.stage
+
+    def on_train_start(self, trainer, pl_module):
+        self.apply(trainer.datamodule.train)
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        if self.weights is None:
+            metric = trainer.callback_metrics.get(self.monitor)
+            if self.threshold is None or (metric is not None and metric > self.threshold):
+                self.stage = min(self.stage + self.step, STAGES - 1)
+        dataset = trainer.datamodule.train
+        self.apply(dataset)
+        pl_module.log('train/stage', dataset.stage, prog_bar=True)
+
+    def on_save_checkpoint(self, *args):
+        return {'stage': self.stage, 'weights': self.weights}
+
+    # The callback state is the last argument in every Lightning version
+    def on_load_checkpoint(self, *args):
+        state = args[-1]
+        self.stage = state['stage']
+        self.weights = state['weights']
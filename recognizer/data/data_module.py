@@ -1,40 +1,50 @@
+import multiprocessing
+import queue
+from collections import defaultdict
 from typing import Union, List, Optional
 
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader, ConcatDataset
-from torchvision import transforms
 
 from . import character_sets
 from . import training_dataset
 from . import validation_dataset
+from .generation_server import GenerationServer, SharedMemoryBatches, RemoteBatches
+from .input_format import image_transform, region_score_transform
+from .profiling import Profiler, chrome_trace_events, export_chrome_trace
 
 
 class RecognizerDataModule(pl.LightningDataModule):
-    train: training_dataset.RecognizerTrainingDataset
+    train: Union[training_dataset.RecognizerTrainingDataset, SharedMemoryBatches, RemoteBatches]
     val: ConcatDataset
     test: ConcatDataset
 
-    def __init__(self, data_folder: str, batch_size: int, character_set_name: str, num_workers: int, **kwargs):
+    # With generation_server="local" training batches are generated by a pool of generation_processes processes
+    # into shared memory, with generation_server="host:port" they are received from a generation server on another
+    # machine, which is authenticated with the secret in $KANJI_GENERATION_AUTHKEY (or the file named by
+    # $KANJI_GENERATION_AUTHKEY_FILE). input_size and channels should match the model. With a seed, and without a
+    # generation server, the training samples are the same on every run, see recognizer.data.snapshot.
+    def __init__(self, data_folder: str, batch_size: int, character_set_name: str, num_workers: int,
+                 generation_server: Optional[str] = None, generation_processes: int = 4,
+                 input_size: int = 128, channels: int = 3, seed: Optional[int] = None, **kwargs):
         super().__init__()
         self.data_folder = data_folder
-        self.transform = transforms.Compose([
-            transforms.ToTensor(),
-            # transforms.Normalize((0.5,), (0.5,))
-        ])
+        self.transform = image_transform(input_size, channels)
+        # transforms.Normalize((0.5,), (0.5,))
+        self.region_score_transform = region_score_transform()
         self.batch_size = batch_size
         self.character_set = character_sets.character_sets[character_set_name]
         self.num_workers = num_workers
+        self.generation_server = generation_server
+        self.generation_processes = generation_processes
+        self.seed = seed
 
     def prepare_data(self, *args, **kwargs):
         pass
 
     def setup(self, stage: Optional[str] = None):
         if stage == 'fit' or stage is None:
-            self.train = training_dataset.RecognizerTrainingDataset(
-                data_folder=self.data_folder,
-                character_set=self.character_set,
-                transform=self.transform
-            )
+            self.train = self.training_data()
             self.val = validation_dataset.dataset_from_folder(
                 data_folder=self.data_folder,
                 character_set=self.character_set,
@@ -48,7 +58,26 @@ class RecognizerDataModule(pl.LightningDataModule):
                 transform=self.transform
             )
 
+    def training_data(self):
+        if self.generation_server is not None and self.generation_server != "local":
+            return RemoteBatches(self.generation_server)
+
+        dataset = training_dataset.RecognizerTrainingDataset(
+            data_folder=self.data_folder,
+            character_set=self.character_set,
+            transform=self.transform,
+            region_score_transform=self.region_score_transform
+        )
+        if self.generation_server is None:
+            dataset.seed = self.seed
+            dataset.batch_size = self.batch_size
+            return dataset
+        return SharedMemoryBatches(GenerationServer(dataset, self.batch_size, self.generation_processes))
+
     def train_dataloader(self, *args, **kwargs) -> DataLoader:
+        if self.generation_server is not None:
+            # Batches arrive complete, and are handed to the trainer without copying
+            return DataLoader(self.train, batch_size=None, num_workers=0)
         return DataLoader(self.train, batch_size=self.batch_size, num_workers=self.num_workers)
 
     def val_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
@@ -56,3 +85,66 @@ class RecognizerDataModule(pl.LightningDataModule):
 
     def test_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
         return DataLoader(self.test, batch_size=self.batch_size, num_workers=self.num_workers)
+
+
+class DataProfilingLogger(pl.Callback):
+    """Logs where the training data generator spends its time, as milliseconds per sample for each phase."""
+
+    def __init__(self, report_every: int = 100, trace_path: Optional[str] = None, max_trace_events: int = 1_000_000):
+        super().__init__()
+        self.queue = multiprocessing.Queue()
+        self.report_every = report_every
+        self.trace_path = trace_path
+        self.max_trace_events = max_trace_events
+        self.trace_events = []
+
+    # The dataset generating the training data in this process or its DataLoader workers, None without a data module
+    # or with a generation server
+    @staticmethod
+    def generator(trainer) -> Optional[training_dataset.RecognizerTrainingDataset]:
+        datamodule = getattr(trainer, 'datamodule', None)
+        train = getattr(datamodule, 'train', None)
+        return train if isinstance(train, training_dataset.RecognizerTrainingDataset) else None
+
+    def on_train_start(self, trainer, pl_module):
+        generator = self.generator(trainer)
+        if generator is None:
+            print("Not profiling the training data, it is not generated by a RecognizerDataModule without a generation "
+                  "server")
+            return
+        # Set before the DataLoader starts its workers, so every worker gets a copy of the profiler
+        generator.profiler = Profiler(
+            queue=self.queue, report_every=self.report_every, trace=self.trace_path is not None
+        )
+
+    def on_train_batch_end(self, trainer, pl_module, *args):
+        reports = []
+        while True:
+            try:
+                reports.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not reports:
+            return
+
+        samples = defaultdict(int)
+        seconds = defaultdict(float)
+        for report in reports:
+            for name, phase in report["phases"].items():
+                seconds[name] += phase["seconds"]
+            samples[report["worker"]] += report["samples"]
+            if len(self.trace_events) < self.max_trace_events:
+                self.trace_events += chrome_trace_events(report)
+
+        total_samples = sum(samples.values())
+        metrics = {f"data/{name}_ms": 1000 * value / total_samples for name, value in seconds.items()}
+        metrics["data/total_ms"] = 1000 * sum(seconds.values()) / total_samples
+        metrics.update({f"data/worker_{worker}_samples": count for worker, count in samples.items()})
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+    def on_train_end(self, trainer, pl_module):
+        generator = self.generator(trainer)
+        if generator is not None:
+            generator.profiler = None
+        if self.trace_path is not None:
+            export_chrome_trace(self.trace_path, self.trace_events)
@@ -1,6 +1,6 @@
 import glob
 import os
-from typing import List, Set
+from typing import List, Set, Dict, Optional, Tuple
 
 from PIL import ImageFont
 from fontTools.ttLib import TTFont
@@ -8,32 +8,55 @@ import json
 from pathlib import Path
 
 
+# Sorted, so fonts are in the same order on every machine
 def font_paths_in_folder(folder):
-    return glob.glob(os.path.join(folder, '**/*.ttf'), recursive=True) + \
-           glob.glob(os.path.join(folder, '**/*.otf'), recursive=True)
+    return sorted(glob.glob(os.path.join(folder, '**/*.ttf'), recursive=True) +
+                  glob.glob(os.path.join(folder, '**/*.otf'), recursive=True))
 
 
 def font_infos_in_folder(folder, characters):
     return [FontInfo.from_font_cached(path, characters) for path in font_paths_in_folder(folder)]
 
 
+# Glyphs are checked for being renderable once per size class, font sizes use the closest smaller size class
+SIZE_CLASSES = (8, 16, 32, 48)
+
+
+def size_class(size):
+    return max([size_class for size_class in SIZE_CLASSES if size_class <= size], default=SIZE_CLASSES[0])
+
+
 class FontInfo:
-    def __init__(self, path: str, characters: List[str], supported_glyphs: Set[str], missing_glyphs: Set[str]):
+    def __init__(self, path: str, characters: List[str], supported_glyphs: Set[str], missing_glyphs: Set[str],
+                 renderable_glyphs: Dict[int, Set[str]]):
         self.path = path
         self.characters = characters
         self.supported_glyphs = supported_glyphs
         self.missing_glyphs = missing_glyphs
+        self.renderable_glyphs = renderable_glyphs
+        # Sorted tuples, so random.choice is O(1) and independent of set ordering
+        self.renderable_sequences: Dict[Optional[int], Tuple[str, ...]] = {
+            size: tuple(sorted(glyphs)) for size, glyphs in renderable_glyphs.items()
+        }
+        self.renderable_sequences[None] = tuple(sorted(
+            set.intersection(*renderable_glyphs.values()) if renderable_glyphs else set()
+        ))
 
     def get(self, size):
         return ImageFont.truetype(self.path, size)
 
+    # Glyphs which render at the given size, or at every size if no size is given
+    def renderable(self, size: Optional[int] = None) -> Tuple[str, ...]:
+        return self.renderable_sequences[None if size is None else size_class(size)]
+
     def to_json(self):
         with open(Path(self.path).with_suffix(".json"), 'w') as file:
             json.dump({
                 "path": self.path,
                 "characters": self.characters,
                 "supported_glyphs": list(self.supported_glyphs),
-                "missing_glyphs": list(self.missing_glyphs)
+                "missing_glyphs": list(self.missing_glyphs),
+                "renderable_glyphs": {size: list(glyphs) for size, glyphs in self.renderable_glyphs.items()}
             }, file)
 
     @staticmethod
@@ -55,21 +78,39 @@ class FontInfo:
                 missing_glyphs.add(character)
         if len(missing_glyphs) > 0:
             print(f"{len(missing_glyphs)}/{len(characters)} characters are missing from {os.path.basename(path)}")
-        return FontInfo(path, characters, supported_glyphs, missing_glyphs)
+        return FontInfo(path, characters, supported_glyphs, missing_glyphs,
+                        FontInfo.renderable_glyphs_in_font(path, supported_glyphs))
+
+    # Some fonts map characters to empty glyphs, these only show up when actually measuring them
+    @staticmethod
+    def renderable_glyphs_in_font(path, glyphs):
+        renderable_glyphs = {}
+        for size in SIZE_CLASSES:
+            font = ImageFont.truetype(path, size)
+            renderable_glyphs[size] = set()
+            for glyph in glyphs:
+                _, _, right, bottom = font.getbbox(glyph, anchor='lt', language='ja')
+                if right != 0 and bottom != 0:
+                    renderable_glyphs[size].add(glyph)
+            if len(renderable_glyphs[size]) < len(glyphs):
+                print(f"{len(glyphs) - len(renderable_glyphs[size])}/{len(glyphs)} characters are empty "
+                      f"in {os.path.basename(path)} at size {size}")
+        return renderable_glyphs
 
     @staticmethod
     def from_json(path):
         with open(Path(path).with_suffix(".json"), 'r') as file:
             data = json.load(file)
             return FontInfo(
-                data['path'], data['characters'], set(data['supported_glyphs']), set(data['missing_glyphs'])
+                data['path'], data['characters'], set(data['supported_glyphs']), set(data['missing_glyphs']),
+                {int(size): set(glyphs) for size, glyphs in data.get('renderable_glyphs', {}).items()}
             )
 
     @staticmethod
     def from_font_cached(path, characters):
         if os.path.exists(Path(path).with_suffix(".json")):
             font_info = FontInfo.from_json(Path(path).with_suffix(".json"))
-            if font_info.characters != characters:
+            if font_info.characters != characters or font_info.renderable_glyphs.keys() != set(SIZE_CLASSES):
                 font_info = FontInfo.from_font(path, characters)
                 font_info.to_json()
             return font_info
@@ -0,0 +1,263 @@
+import argparse
+import collections
+import multiprocessing
+import os
+import random
+from multiprocessing.connection import Client, Listener
+from typing import *
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+
+from recognizer.data import character_sets
+from recognizer.data.input_format import image_transform, region_score_transform
+from recognizer.data.training_dataset import RecognizerTrainingDataset, STAGES, stage_weights, expected_stage
+from recognizer.runtime import parse_cpus
+
+# The shared secret of a generation server and its trainers, or the path of a file holding it
+AUTHKEY_VARIABLE = "KANJI_GENERATION_AUTHKEY"
+AUTHKEY_FILE_VARIABLE = "KANJI_GENERATION_AUTHKEY_FILE"
+
+
+class BatchRing:
+    """Slots for batches in shared memory, passed back and forth between producer processes and a consumer.
+
+    Producers take the index of a free slot from `free`, fill the slot with a batch and put the index in `full`.
+    The consumer reads full slots in place and puts their indices back in `free` when it is done with them.
+    """
+
+    def __init__(self, sample: Tuple[torch.Tensor, int, torch.Tensor], batch_size: int, slots: int, context):
+        image, _, region_score = sample
+        self.images = torch.zeros((slots, batch_size, *image.shape), dtype=image.dtype).share_memory_()
+        self.labels = torch.zeros((slots, batch_size), dtype=torch.long).share_memory_()
+        self.region_scores = torch.zeros(
+            (slots, batch_size, *region_score.shape), dtype=region_score.dtype
+        ).share_memory_()
+        self.free = context.Queue()
+        self.full = context.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def batch(self, slot: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return self.images[slot], self.labels[slot], self.region_scores[slot]
+
+
+def produce(dataset: RecognizerTrainingDataset, ring: BatchRing, seed: int, cpus: Optional[Set[int]]):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(1)
+    # Forked producers start out with the same random state
+    random.seed(seed)
+    np.random.seed(seed)
+
+    while True:
+        slot = ring.free.get()
+        images, labels, region_scores = ring.batch(slot)
+        for i in range(len(labels)):
+            images[i], labels[i], region_scores[i] = dataset.generate()
+        ring.full.put(slot)
+
+
+class GenerationServer:
+    """Generates batches of training samples in a pool of processes, into a BatchRing.
+
+    The producers are forked from the process holding the dataset, so the fonts and backgrounds are loaded once and
+    shared between them instead of being loaded by every DataLoader worker, as are the stage and label weights of the
+    dataset.
+    """
+
+    def __init__(self, dataset: RecognizerTrainingDataset, batch_size: int, processes: int = 4,
+                 slots: Optional[int] = None, cpus: Optional[Set[int]] = None, seed: int = 0):
+        context = multiprocessing.get_context('fork')
+        # The shape of the slots is taken from a sample, so it follows the transform of the dataset
+        self.dataset = dataset
+        self.ring = BatchRing(dataset.generate(), batch_size, slots or 2 * processes + 2, context)
+        self.processes = [
+            context.Process(target=produce, args=(dataset, self.ring, seed + i, cpus), daemon=True)
+            for i in range(processes)
+        ]
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        for process in self.processes:
+            process.start()
+        self.started = True
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        self.started = False
+
+
+class SharedMemoryBatches(IterableDataset):
+    """Batches from a GenerationServer in the same machine, as views of its shared memory.
+
+    A batch stays valid until `held` more batches have been taken, as Lightning fetches the next batch while the
+    current one is still in use. Use with DataLoader(batch_size=None, num_workers=0).
+    """
+
+    def __init__(self, server: GenerationServer, held: int = 2):
+        super().__init__()
+        self.server = server
+        self.held = held
+        self.in_use = collections.deque()
+
+    @property
+    def stage(self) -> float:
+        return self.server.dataset.stage
+
+    @stage.setter
+    def stage(self, stage: float):
+        self.server.dataset.stage = stage
+
+    @property
+    def stage_weights(self):
+        return self.server.dataset.stage_weights
+
+    @property
+    def label_sampler(self):
+        return self.server.dataset.label_sampler
+
+    def __iter__(self):
+        self.server.start()
+        ring = self.server.ring
+        # The slots still held by the previous iterator, abandoned at the end of every epoch, are given back
+        while self.in_use:
+            ring.free.put(self.in_use.popleft())
+        in_use = self.in_use = collections.deque()
+        while True:
+            slot = ring.full.get()
+            in_use.append(slot)
+            if len(in_use) > self.held:
+                ring.free.put(in_use.popleft())
+            yield ring.batch(slot)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+# There is no default secret, anyone knowing it can connect to the server
+def read_authkey(path: Optional[str] = None) -> bytes:
+    path = path or os.environ.get(AUTHKEY_FILE_VARIABLE)
+    if path:
+        with open(path, 'rb') as file:
+            authkey = file.read().strip()
+    else:
+        authkey = os.environ.get(AUTHKEY_VARIABLE, "").encode()
+    if not authkey:
+        raise ValueError(f"No authkey for the generation server, set {AUTHKEY_VARIABLE} or {AUTHKEY_FILE_VARIABLE}")
+    return authkey
+
+
+# Stage weights are sent as raw float64s rather than pickled, so a client cannot make the server run code
+def send_stage_weights(connection, weights: Sequence[float]):
+    connection.send_bytes(np.asarray(weights, dtype=np.float64).tobytes())
+
+
+def receive_stage_weights(connection) -> np.ndarray:
+    message = connection.recv_bytes(maxlength=STAGES * 8)
+    if len(message) != STAGES * 8:
+        raise ValueError(f"Expected {STAGES} stage weights, got {len(message)} bytes")
+    return np.frombuffer(message, dtype=np.float64)
+
+
+# Sends batches from the server to one remote trainer at a time. The trainer sends its stage weights to ask for a
+# batch, and the batch is sent straight from its slot.
+def serve(server: GenerationServer, address: str, authkey: bytes):
+    server.start()
+    ring = server.ring
+    header = [(tuple(tensor.shape), str(tensor.dtype).replace("torch.", "")) for tensor in ring.batch(0)]
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        while True:
+            try:
+                connection = listener.accept()
+            except (EOFError, OSError, multiprocessing.AuthenticationError) as error:
+                print(f"Refused a connection: {error}")
+                continue
+            with connection:
+                print(f"Serving batches to {listener.last_accepted}")
+                connection.send(header)
+                try:
+                    while True:
+                        server.dataset.stage_weights[:] = receive_stage_weights(connection)
+                        slot = ring.full.get()
+                        try:
+                            for tensor in ring.batch(slot):
+                                connection.send_bytes(tensor.numpy())
+                        finally:
+                            ring.free.put(slot)
+                except (EOFError, OSError, ValueError) as error:
+                    print(f"Connection to {listener.last_accepted} closed: {error or type(error).__name__}")
+
+
+class RemoteBatches(IterableDataset):
+    """Batches from a generation server on another machine. Use with DataLoader(batch_size=None, num_workers=0)."""
+
+    def __init__(self, address: str, authkey: Optional[bytes] = None, stage: float = 0):
+        super().__init__()
+        self.address = address
+        self.authkey = authkey or read_authkey()
+        self.stage_weights = stage_weights(stage)
+
+    @property
+    def stage(self) -> float:
+        return expected_stage(self.stage_weights)
+
+    @stage.setter
+    def stage(self, stage: float):
+        self.stage_weights[:] = stage_weights(stage)
+
+    def __iter__(self):
+        with Client(parse_address(self.address), authkey=self.authkey) as connection:
+            header = connection.recv()
+            # Ask for the next batch before handing out the current one, so it is sent while training
+            send_stage_weights(connection, self.stage_weights)
+            while True:
+                batch = []
+                for shape, dtype in header:
+                    tensor = torch.empty(shape, dtype=getattr(torch, dtype))
+                    connection.recv_bytes_into(memoryview(tensor.numpy()).cast('B'))
+                    batch.append(tensor)
+                send_stage_weights(connection, self.stage_weights)
+                yield tuple(batch)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate training batches for a trainer on another machine.")
+    parser.add_argument("--address", type=str, default="127.0.0.1:6000",
+                        help="host:port to listen on, 0.0.0.0 to accept other machines (default: 127.0.0.1:6000)")
+    parser.add_argument("--authkey-file", type=str, default=None,
+                        help=f"file holding the shared secret of the server and trainers "
+                             f"(default: ${AUTHKEY_FILE_VARIABLE}, else the secret in ${AUTHKEY_VARIABLE})")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing fonts and backgrounds (default: data)")
+    parser.add_argument("--character-set-name", type=str, default="frequent_kanji_plus",
+                        choices=character_sets.character_sets.keys())
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--input-size", type=int, default=128, help="input size of the model (default: 128)")
+    parser.add_argument("--channels", type=int, default=3, choices=[1, 3],
+                        help="input channels of the model (default: 3)")
+    parser.add_argument("--processes", type=int, default=4, help="number of producer processes (default: 4)")
+    parser.add_argument("--cpus", type=str, default=None, help="cpus to run the producers on, e.g. 4-7")
+    args = parser.parse_args()
+    try:
+        authkey = read_authkey(args.authkey_file)
+    except ValueError as error:
+        parser.error(str(error))
+
+    dataset = RecognizerTrainingDataset(
+        data_folder=args.data_folder,
+        character_set=character_sets.character_sets[args.character_set_name],
+        # Same transforms as RecognizerDataModule
+        transform=image_transform(args.input_size, args.channels),
+        region_score_transform=region_score_transform()
+    )
+    server = GenerationServer(
+        dataset, args.batch_size, args.processes, cpus=parse_cpus(args.cpus) if args.cpus else None
+    )
+    serve(server, args.address, authkey)
@@ -0,0 +1,200 @@
+"""Golden outputs of the training data generator, to check that optimizations of it leave the samples unchanged.
+
+Recording renders a fixed seeded set of samples of every stage and saves them with the generation throughput.
+Checking renders them again and compares them to the goldens within tolerances: the per-pixel differences, the
+statistics of the images and the IoU of the region scores, checks the labels against the weights of the label sampler,
+and reports the change in throughput. Runs on the cpu.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+from typing import *
+
+import numpy as np
+
+from recognizer.data import character_sets
+from recognizer.data.snapshot import seeded_dataset, character_set_hash
+from recognizer.data.training_dataset import RecognizerTrainingDataset, STAGES
+
+LABEL_BINS = 10
+
+
+class Tolerances(NamedTuple):
+    # Pixels of a sample may differ by this much in any channel without counting as different
+    pixel: int = 8
+    # Fraction of the pixels of a stage allowed to differ by more than the pixel tolerance
+    pixel_fraction: float = 0.01
+    # Largest change of the mean or standard deviation of any channel over a stage, in pixel values
+    statistic: float = 2.0
+    # Largest chi-square statistic of the labels of a stage in LABEL_BINS bins of equal sampling weight. With the
+    # default, 0.1% of the stages drawn from the sampler fail.
+    label_chi_square: float = 27.9
+    # Smallest mean IoU of the region scores of a stage, thresholded at half their range
+    region_score_iou: float = 0.95
+
+
+def render(dataset: RecognizerTrainingDataset, stage: int, samples: int) \
+        -> Tuple[List[np.ndarray], np.ndarray, List[np.ndarray], float]:
+    dataset.stage = stage
+    images = []
+    labels = []
+    region_scores = []
+    start = time.perf_counter()
+    for index in range(samples):
+        image, label, region_score = dataset[index]
+        images.append(np.asarray(image))
+        labels.append(label)
+        region_scores.append(np.asarray(region_score))
+    samples_per_second = samples / (time.perf_counter() - start)
+    return images, np.array(labels), region_scores, samples_per_second
+
+
+def image_statistics(images: List[np.ndarray]) -> Dict[str, List[float]]:
+    pixels = np.concatenate([image.reshape(-1, image.shape[-1] if image.ndim == 3 else 1) for image in images])
+    return {"mean": pixels.mean(axis=0).tolist(), "std": pixels.std(axis=0).tolist()}
+
+
+def stage_path(folder: str, stage: int) -> str:
+    return os.path.join(folder, f"stage_{stage}.npz")
+
+
+def record(dataset: RecognizerTrainingDataset, folder: str, samples: int) -> Dict[str, Any]:
+    pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+    stages = {}
+    for stage in range(STAGES):
+        images, labels, region_scores, samples_per_second = render(dataset, stage, samples)
+        # Region scores are not the same size in every stage, so every sample is stored separately
+        np.savez_compressed(
+            stage_path(folder, stage),
+            labels=labels,
+            **{f"image_{index}": image for index, image in enumerate(images)},
+            **{f"region_score_{index}": region_score for index, region_score in enumerate(region_scores)}
+        )
+        stages[str(stage)] = {"samples_per_second": samples_per_second, **image_statistics(images)}
+    return {
+        "seed": dataset.seed,
+        "samples": samples,
+        "character_set_hash": character_set_hash(dataset.characters),
+        "stages": stages,
+    }
+
+
+def load(folder: str, stage: int, samples: int) -> Tuple[List[np.ndarray], np.ndarray, List[np.ndarray]]:
+    with np.load(stage_path(folder, stage)) as golden:
+        return (
+            [golden[f"image_{index}"] for index in range(samples)],
+            golden["labels"],
+            [golden[f"region_score_{index}"] for index in range(samples)],
+        )
+
+
+def iou(golden: np.ndarray, actual: np.ndarray) -> float:
+    if golden.shape != actual.shape:
+        return 0.0
+    golden = golden > 127
+    actual = actual > 127
+    union = np.logical_or(golden, actual).sum()
+    return np.logical_and(golden, actual).sum() / union if union > 0 else 1.0
+
+
+# Goodness of fit of the labels to the sampling weights. The few samples of a stage spread over thousands of classes
+# would make any per-class comparison either exact or noise, so the classes are grouped into bins of about equal weight.
+def label_chi_square(labels: np.ndarray, weights: np.ndarray, bins: int = LABEL_BINS) -> float:
+    cumulative = np.cumsum(weights) / np.sum(weights)
+    # First class of every bin after the first
+    edges = np.searchsorted(cumulative, np.arange(1, bins) / bins, side='right')
+    probabilities = np.diff(np.concatenate([[0.0], cumulative[edges - 1], [1.0]]))
+    observed = np.bincount(np.searchsorted(edges, labels, side='right'), minlength=bins)
+    expected = probabilities * len(labels)
+    present = expected > 0
+    return float(((observed[present] - expected[present]) ** 2 / expected[present]).sum())
+
+
+def different_pixels(golden: np.ndarray, actual: np.ndarray, tolerance: int) -> int:
+    if golden.shape != actual.shape:
+        return golden.size
+    return int((np.abs(golden.astype(np.int16) - actual.astype(np.int16)) > tolerance).sum())
+
+
+# Compares a stage to its goldens, returning the measurements and the ones outside the tolerances
+def compare(dataset: RecognizerTrainingDataset, folder: str, stage: int, manifest: Dict[str, Any],
+            tolerances: Tolerances) -> Tuple[Dict[str, float], List[str]]:
+    samples = manifest["samples"]
+    golden_images, _, golden_region_scores = load(folder, stage, samples)
+    images, labels, region_scores, samples_per_second = render(dataset, stage, samples)
+    golden_statistics = manifest["stages"][str(stage)]
+    statistics = image_statistics(images)
+
+    result = {
+        "pixel_fraction": sum(different_pixels(golden, actual, tolerances.pixel)
+                              for golden, actual in zip(golden_images, images)) /
+                          sum(golden.size for golden in golden_images),
+        "statistic": max(
+            abs(old - new)
+            for name in ["mean", "std"]
+            for old, new in zip(golden_statistics[name], statistics[name])
+        ),
+        "label_chi_square": label_chi_square(labels, dataset.label_sampler.weights),
+        "region_score_iou": float(np.mean([iou(golden, actual)
+                                           for golden, actual in zip(golden_region_scores, region_scores)])),
+        "samples_per_second": samples_per_second,
+        "speedup": samples_per_second / golden_statistics["samples_per_second"],
+    }
+    failures = [
+        name for name in ["pixel_fraction", "statistic", "label_chi_square"]
+        if result[name] > getattr(tolerances, name)
+    ]
+    if result["region_score_iou"] < tolerances.region_score_iou:
+        failures.append("region_score_iou")
+    return result, failures
+
+
+if __name__ == '__main__':
+    defaults = Tolerances()
+    parser = argparse.ArgumentParser(description="Record or check golden outputs of the training data generator.")
+    parser.add_argument("command", choices=["record", "check"])
+    parser.add_argument("--golden-folder", type=str, default="generated/golden",
+                        help="folder the goldens are saved to (default: generated/golden)")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing fonts and backgrounds (default: data)")
+    parser.add_argument("--character-set-name", type=str, default="frequent_kanji_plus",
+                        choices=character_sets.registry.keys(), help="used when recording")
+    parser.add_argument("--seed", type=int, default=0, help="used when recording")
+    parser.add_argument("--samples", type=int, default=200, help="samples per stage, when recording (default: 200)")
+    parser.add_argument("--pixel-tolerance", type=int, default=defaults.pixel)
+    parser.add_argument("--pixel-fraction", type=float, default=defaults.pixel_fraction)
+    parser.add_argument("--statistic-tolerance", type=float, default=defaults.statistic)
+    parser.add_argument("--label-chi-square", type=float, default=defaults.label_chi_square)
+    parser.add_argument("--region-score-iou", type=float, default=defaults.region_score_iou)
+    args = parser.parse_args()
+
+    manifest_path = os.path.join(args.golden_folder, "golden.json")
+    if args.command == "record":
+        dataset = seeded_dataset(args.data_folder, args.character_set_name, args.seed)
+        manifest = {"character_set_name": args.character_set_name,
+                    **record(dataset, args.golden_folder, args.samples)}
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file, indent=1)
+        for stage, statistics in manifest["stages"].items():
+            print(f"Stage {stage}: {statistics['samples_per_second']:.1f} samples/s")
+    else:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        dataset = seeded_dataset(args.data_folder, manifest["character_set_name"], manifest["seed"])
+        if character_set_hash(dataset.characters) != manifest["character_set_hash"]:
+            sys.exit(f"Character set {manifest['character_set_name']} changed since the goldens were recorded")
+        tolerances = Tolerances(args.pixel_tolerance, args.pixel_fraction, args.statistic_tolerance,
+                                args.label_chi_square, args.region_score_iou)
+        failed = False
+        for stage in range(STAGES):
+            result, failures = compare(dataset, args.golden_folder, stage, manifest, tolerances)
+            print(f"Stage {stage}: {result['pixel_fraction']:.4f} pixels differ, statistics {result['statistic']:.2f}, "
+                  f"labels chi-square {result['label_chi_square']:.1f}, region score IoU {result['region_score_iou']:.3f}, "
+                  f"{result['samples_per_second']:.1f} samples/s ({result['speedup']:.2f}x)"
+                  + (f" FAILED: {', '.join(failures)}" if failures else ""))
+            failed |= bool(failures)
+        sys.exit(1 if failed else 0)
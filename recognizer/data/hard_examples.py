@@ -0,0 +1,82 @@
+from typing import *
+
+import numpy as np
+import pytorch_lightning as pl
+
+
+class HardExampleMining(pl.Callback):
+    """Biases the labels of the generated samples towards the characters the model gets wrong.
+
+    Keeps moving averages of the training loss and accuracy of every class, from the per-sample losses stored by
+    training_step. Every `update_every` batches the label weights of the dataset are set to `floor` plus the average
+    loss of the class, plus `confusion_weight` times the average loss of the samples of other classes mistaken for it,
+    so both characters of a confusable pair are generated more often.
+    """
+
+    def __init__(self, decay: float = 0.99, floor: float = 0.1, confusion_weight: float = 0.5,
+                 update_every: int = 50):
+        super().__init__()
+        self.decay = decay
+        self.floor = floor
+        self.confusion_weight = confusion_weight
+        self.update_every = update_every
+        self.losses: Optional[np.ndarray] = None
+        self.accuracies: Optional[np.ndarray] = None
+        self.confusion: Optional[np.ndarray] = None
+        self.batches = 0
+
+    def on_train_start(self, trainer, pl_module):
+        classes = len(pl_module.character_set)
+        if self.losses is None or len(self.losses) != classes:
+            # Unseen classes start out as hard as possible, the loss of a uniform guess
+            self.losses = np.full(classes, np.log(classes))
+            self.accuracies = np.zeros(classes)
+            self.confusion = np.zeros(classes)
+        self.update_weights(trainer)
+
+    def on_train_batch_end(self, trainer, pl_module, *args):
+        labels, losses, predicted = (tensor.cpu().numpy() for tensor in pl_module.sample_losses)
+        classes = len(self.losses)
+
+        counts = np.bincount(labels, minlength=classes)
+        seen = counts > 0
+        batch_losses = np.bincount(labels, weights=losses, minlength=classes)[seen] / counts[seen]
+        batch_accuracies = np.bincount(labels, weights=predicted == labels, minlength=classes)[seen] / counts[seen]
+        self.losses[seen] = self.decay * self.losses[seen] + (1 - self.decay) * batch_losses
+        self.accuracies[seen] = self.decay * self.accuracies[seen] + (1 - self.decay) * batch_accuracies
+
+        predicted_counts = np.bincount(predicted, minlength=classes)
+        guessed = predicted_counts > 0
+        wrong = predicted != labels
+        mistaken = np.bincount(predicted[wrong], weights=losses[wrong], minlength=classes)
+        batch_confusion = mistaken[guessed] / predicted_counts[guessed]
+        self.confusion[guessed] = self.decay * self.confusion[guessed] + (1 - self.decay) * batch_confusion
+
+        self.batches += 1
+        if self.batches % self.update_every == 0:
+            self.update_weights(trainer)
+            pl_module.log('train/class_accuracy_mean', float(self.accuracies.mean()))
+            pl_module.log('train/class_accuracy_min', float(self.accuracies.min()))
+
+    def update_weights(self, trainer):
+        label_sampler = getattr(trainer.datamodule.train, 'label_sampler', None)
+        if label_sampler is None:
+            return
+        label_sampler.set_weights(self.floor + self.losses + self.confusion_weight * self.confusion)
+
+    def on_save_checkpoint(self, *args):
+        if self.losses is None:
+            return {}
+        return {
+            'losses': self.losses.tolist(),
+            'accuracies': self.accuracies.tolist(),
+            'confusion': self.confusion.tolist(),
+        }
+
+    # The callback state is the last argument in every Lightning version
+    def on_load_checkpoint(self, *args):
+        state = args[-1]
+        if state:
+            self.losses = np.array(state['losses'])
+            self.accuracies = np.array(state['accuracies'])
+            self.confusion = np.array(state['confusion'])
@@ -0,0 +1,26 @@
+from torchvision import transforms
+
+# Samples are rendered at this size, and resized to the input size of the model
+RENDER_SIZE = 128
+
+
+# Transform of the rendered samples into model input, of input_size x input_size pixels with 1 (grayscale) or 3 (RGB)
+# channels
+def image_transform(input_size: int = RENDER_SIZE, channels: int = 3):
+    steps = []
+    if input_size != RENDER_SIZE:
+        steps.append(transforms.Resize((input_size, input_size)))
+    if channels == 1:
+        steps.append(transforms.Grayscale())
+    steps.append(transforms.ToTensor())
+    return transforms.Compose(steps)
+
+
+# Region scores keep their own resolution, whatever the input size
+def region_score_transform():
+    return transforms.ToTensor()
+
+
+def model_input_format(model) -> (int, int):
+    hparams = getattr(model, 'hparams', {})
+    return hparams.get('input_size', RENDER_SIZE), hparams.get('channels', 3)
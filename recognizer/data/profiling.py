@@ -0,0 +1,91 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import *
+
+from torch.utils.data import get_worker_info
+
+
+class Profiler:
+    """Accumulates wall time per named phase.
+
+    Phases may be nested, the time of a nested phase is only counted towards the innermost phase, so the totals of
+    all phases add up to the time spent inside the outermost phases.
+
+    When given a queue, the profiler reports and resets its totals every `report_every` samples. Each DataLoader
+    worker holds its own copy of the profiler, so the reports arrive aggregated per worker.
+    """
+
+    def __init__(self, queue=None, report_every: int = 100, trace: bool = False):
+        self.totals: DefaultDict[str, float] = defaultdict(float)
+        self.counts: DefaultDict[str, int] = defaultdict(int)
+        self.samples = 0
+        self.queue = queue
+        self.report_every = report_every
+        self.trace = trace
+        self.events = []
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name: str):
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            end = time.perf_counter()
+            elapsed = end - frame[0]
+            self.totals[name] += elapsed - frame[1]
+            self.counts[name] += 1
+            if self._stack:
+                self._stack[-1][1] += elapsed
+            if self.trace:
+                self.events.append((name, frame[0], end))
+
+    def sample_done(self):
+        self.samples += 1
+        if self.queue is not None and self.samples >= self.report_every:
+            self.queue.put(self.report())
+            self.reset()
+
+    def report(self) -> Dict[str, Any]:
+        worker_info = get_worker_info()
+        return {
+            "worker": -1 if worker_info is None else worker_info.id,
+            "pid": os.getpid(),
+            "samples": self.samples,
+            "phases": self.summary(),
+            "events": list(self.events),
+        }
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+        self.samples = 0
+        self.events.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {"seconds": self.totals[name], "count": self.counts[name]}
+            for name in sorted(self.totals)
+        }
+
+
+def chrome_trace_events(report: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{
+        "name": name,
+        "ph": "X",
+        "ts": start * 1e6,
+        "dur": (end - start) * 1e6,
+        "pid": report["pid"],
+        "tid": report["worker"],
+    } for name, start, end in report["events"]]
+
+
+def export_chrome_trace(path: str, events: List[Dict[str, Any]]):
+    # The result can be opened in chrome://tracing or https://ui.perfetto.dev
+    with open(path, 'w') as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,102 @@
+import multiprocessing
+import random
+from typing import *
+
+import numpy as np
+
+
+class FenwickTree:
+    """Prefix sums of weights, for drawing weighted random indices and updating single weights in O(log n)."""
+
+    def __init__(self, weights: Sequence[float]):
+        self.size = len(weights)
+        self.weights = np.array(weights, dtype=np.float64)
+        self.tree = [0.0] * (self.size + 1)
+        for i, weight in enumerate(self.weights, start=1):
+            self.tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.top = 1 << (self.size.bit_length() - 1) if self.size > 0 else 0
+
+    def update(self, index: int, weight: float):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self) -> float:
+        total = 0.0
+        i = self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    # The index i where the sum of the weights before i is at most value, and the sum up to and including i is above
+    def find(self, value: float) -> int:
+        position = 0
+        step = self.top
+        while step > 0:
+            if position + step <= self.size and self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return min(position, self.size - 1)
+
+    def sample(self) -> int:
+        return self.find(random.random() * self.total())
+
+
+class LabelSampler:
+    """Draws labels with weights that can be changed by the trainer while DataLoader workers are running.
+
+    The weights are in shared memory together with a version counter. Each process draws from its own Fenwick tree,
+    and every `refresh_every` draws it applies the weights changed since the last version it saw.
+    """
+
+    def __init__(self, count: int, refresh_every: int = 256):
+        self.shared_weights = multiprocessing.Array('d', [1.0] * count, lock=False)
+        self.version = multiprocessing.Value('L', 0, lock=False)
+        self.refresh_every = refresh_every
+        self.tree: Optional[FenwickTree] = None
+        self.tree_version = -1
+        self.draws = 0
+
+    # Shared memory can only be inherited by forked processes, pickled copies get their own weights
+    def __getstate__(self):
+        return {'weights': list(self.shared_weights), 'refresh_every': self.refresh_every}
+
+    def __setstate__(self, state):
+        self.__init__(len(state['weights']), state['refresh_every'])
+        self.shared_weights[:] = state['weights']
+
+    @property
+    def weights(self) -> np.ndarray:
+        return np.frombuffer(self.shared_weights, dtype=np.float64)
+
+    def set_weights(self, weights: Sequence[float]):
+        self.weights[:] = weights
+        self.version.value += 1
+
+    def refresh(self):
+        self.tree_version = self.version.value
+        weights = self.weights.copy()
+        if self.tree is None:
+            self.tree = FenwickTree(weights)
+            return
+        changed = np.flatnonzero(weights != self.tree.weights)
+        # Rebuilding is cheaper than updating most of the weights one by one
+        if len(changed) > len(weights) // 8:
+            self.tree = FenwickTree(weights)
+            return
+        for index in changed:
+            self.tree.update(index, weights[index])
+
+    def sample(self) -> int:
+        if self.tree is None or (self.draws % self.refresh_every == 0 and self.version.value != self.tree_version):
+            self.refresh()
+        self.draws += 1
+        return self.tree.sample()
@@ -0,0 +1,170 @@
+"""Snapshots of the generated training data.
+
+A snapshot is a manifest of a seed, the character set and the hashes of the fonts and backgrounds, which together
+determine every generated sample, plus hashes of the first samples of every stage. Verifying a snapshot regenerates
+those samples, so changes to the generator can be checked for giving the same output.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+from typing import *
+
+import numpy as np
+import PIL
+import torch
+from PIL import Image, features
+
+from recognizer.data import character_sets, fonts
+from recognizer.data.training_dataset import RecognizerTrainingDataset, STAGES, background_paths
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def character_set_hash(characters: List[str]) -> str:
+    if isinstance(characters, character_sets.CharacterSet):
+        return characters.content_hash
+    return character_sets.CharacterSet(characters).content_hash
+
+
+# Hashes of the files the samples are generated from, by path relative to the data folder
+def input_hashes(data_folder: str) -> Dict[str, Dict[str, str]]:
+    def hashes(paths):
+        return {os.path.relpath(path, data_folder).replace(os.sep, "/"): file_sha256(path) for path in paths}
+
+    return {
+        "fonts": hashes(fonts.font_paths_in_folder(os.path.join(data_folder, "fonts"))),
+        "backgrounds": hashes(background_paths(os.path.join(data_folder, "backgrounds"))),
+    }
+
+
+# Rendering differs between versions of these, so they are recorded to explain mismatching samples
+def versions() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "freetype": features.version("freetype2") or "",
+        "raqm": features.version("raqm") or "",
+        "torch": torch.__version__,
+    }
+
+
+def sample_hash(sample: Tuple[Image.Image, int, Image.Image]) -> str:
+    image, label, region_score = sample
+    digest = hashlib.sha256()
+    for part in [image.mode, image.size, label, region_score.mode, region_score.size]:
+        digest.update(repr(part).encode())
+    digest.update(image.tobytes())
+    digest.update(region_score.tobytes())
+    return digest.hexdigest()
+
+
+# Hashes of the first samples of a stage, one per sample to find the first one differing
+def stage_hashes(dataset: RecognizerTrainingDataset, stage: int, samples: int) -> List[str]:
+    dataset.stage = stage
+    return [sample_hash(dataset[index]) for index in range(samples)]
+
+
+def seeded_dataset(data_folder: str, character_set_name: str, seed: int, transform=None,
+                   region_score_transform=None) -> RecognizerTrainingDataset:
+    dataset = RecognizerTrainingDataset(
+        data_folder=data_folder,
+        character_set=character_sets.registry[character_set_name],
+        transform=transform,
+        region_score_transform=region_score_transform
+    )
+    dataset.seed = seed
+    return dataset
+
+
+def create(data_folder: str, character_set_name: str, seed: int, samples: int) -> Dict[str, Any]:
+    dataset = seeded_dataset(data_folder, character_set_name, seed)
+    return {
+        "seed": seed,
+        "character_set_name": character_set_name,
+        "character_set_hash": character_set_hash(dataset.characters),
+        **input_hashes(data_folder),
+        "versions": versions(),
+        "samples": {str(stage): stage_hashes(dataset, stage, samples) for stage in range(STAGES)},
+    }
+
+
+def changed_files(expected: Dict[str, str], actual: Dict[str, str]) -> List[str]:
+    return sorted(
+        [f"missing {path}" for path in expected.keys() - actual.keys()] +
+        [f"added {path}" for path in actual.keys() - expected.keys()] +
+        [f"changed {path}" for path in expected.keys() & actual.keys() if expected[path] != actual[path]]
+    )
+
+
+# Differences between a snapshot and what the data folder generates now, empty when they are the same. Other library
+# versions are not a problem by themselves, they often render the same.
+def verify(manifest: Dict[str, Any], data_folder: str, samples: Optional[int] = None) -> List[str]:
+    problems = []
+    inputs = input_hashes(data_folder)
+    for kind in ["fonts", "backgrounds"]:
+        problems += changed_files(manifest[kind], inputs[kind])
+
+    dataset = seeded_dataset(data_folder, manifest["character_set_name"], manifest["seed"])
+    if character_set_hash(dataset.characters) != manifest["character_set_hash"]:
+        problems.append(f"character set {manifest['character_set_name']} changed")
+
+    for stage, expected in manifest["samples"].items():
+        expected = expected[:samples]
+        actual = stage_hashes(dataset, int(stage), len(expected))
+        mismatches = [index for index, (old, new) in enumerate(zip(expected, actual)) if old != new]
+        if mismatches:
+            problems.append(f"stage {stage}: {len(mismatches)}/{len(expected)} samples differ, "
+                            f"the first is sample {mismatches[0]}")
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create or verify a snapshot of the generated training data.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="save a manifest of the data and hashes of its samples")
+    create_parser.add_argument("manifest", type=str, help="path to save the manifest to")
+    create_parser.add_argument("--seed", type=int, default=0)
+    create_parser.add_argument("--samples", type=int, default=100, help="samples hashed per stage (default: 100)")
+    create_parser.add_argument("--character-set-name", type=str, default="frequent_kanji_plus",
+                               choices=character_sets.registry.keys())
+
+    verify_parser = subparsers.add_parser("verify", help="check that the data still generates the same samples")
+    verify_parser.add_argument("manifest", type=str, help="path to a manifest")
+    verify_parser.add_argument("--samples", type=int, default=None,
+                               help="samples checked per stage (default: all in the manifest)")
+
+    for subparser in [create_parser, verify_parser]:
+        subparser.add_argument("--data-folder", type=str, default="data",
+                               help="path to a folder containing fonts and backgrounds (default: data)")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        manifest = create(args.data_folder, args.character_set_name, args.seed, args.samples)
+        with open(args.manifest, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=1)
+        print(f"Hashed {len(manifest['fonts'])} fonts, {len(manifest['backgrounds'])} backgrounds and "
+              f"{args.samples} samples of each of {STAGES} stages")
+    else:
+        with open(args.manifest, encoding="utf-8") as file:
+            manifest = json.load(file)
+        current_versions = versions()
+        for name, version in manifest["versions"].items():
+            if current_versions.get(name) != version:
+                print(f"{name} {version} -> {current_versions.get(name)}")
+        problems = verify(manifest, args.data_folder, args.samples)
+        for problem in problems:
+            print(problem)
+        print("Snapshot differs" if problems else "Snapshot verified")
+        sys.exit(1 if problems else 0)
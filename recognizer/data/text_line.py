@@ -0,0 +1,71 @@
+import collections
+from typing import *
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+class Glyph(NamedTuple):
+    # Coverage of the glyph's ink
+    mask: Image.Image
+    # Offset from the pen position on the baseline to the top left of the mask
+    left: int
+    top: int
+    advance: float
+
+
+class TextLine(NamedTuple):
+    # Coverage of the ink of the whole line
+    mask: Image.Image
+    # Ink box of every character, as (left, top, right, bottom) in mask coordinates
+    boxes: List[Tuple[int, int, int, int]]
+
+
+class GlyphCache:
+    """Lays out lines of text from cached per-glyph bitmaps.
+
+    Japanese text is monospaced without kerning or ligatures, so placing glyphs one advance apart gives the same
+    layout as PIL, while only rasterizing each (font, size, character) once and yielding exact boxes per character.
+    """
+
+    def __init__(self, max_glyphs: int = 100_000):
+        self.max_glyphs = max_glyphs
+        self.glyphs: Dict[Tuple[str, int, str], Glyph] = collections.OrderedDict()
+
+    def glyph(self, font: ImageFont.FreeTypeFont, character: str) -> Glyph:
+        key = (font.path, font.size, character)
+        glyph = self.glyphs.get(key)
+        if glyph is not None:
+            self.glyphs.move_to_end(key)
+            return glyph
+
+        left, top, right, bottom = font.getbbox(character, anchor='ls', language='ja')
+        mask = Image.new('L', (max(right - left, 0), max(bottom - top, 0)), color=(0,))
+        ImageDraw.Draw(mask).text((-left, -top), character, font=font, fill=(255,), anchor='ls', language='ja')
+        glyph = Glyph(mask, left, top, font.getlength(character, language='ja'))
+
+        self.glyphs[key] = glyph
+        if len(self.glyphs) > self.max_glyphs:
+            self.glyphs.popitem(last=False)
+        return glyph
+
+    def render_line(self, font: ImageFont.FreeTypeFont, text: str) -> TextLine:
+        glyphs = [self.glyph(font, character) for character in text]
+
+        boxes = []
+        pen = 0.0
+        for glyph in glyphs:
+            left = round(pen) + glyph.left
+            boxes.append((left, glyph.top, left + glyph.mask.width, glyph.top + glyph.mask.height))
+            pen += glyph.advance
+
+        min_x = min(box[0] for box in boxes)
+        min_y = min(box[1] for box in boxes)
+        max_x = max(box[2] for box in boxes)
+        max_y = max(box[3] for box in boxes)
+        boxes = [(left - min_x, top - min_y, right - min_x, bottom - min_y) for left, top, right, bottom in boxes]
+
+        mask = Image.new('L', (max_x - min_x, max_y - min_y), color=(0,))
+        for glyph, box in zip(glyphs, boxes):
+            if glyph.mask.width > 0 and glyph.mask.height > 0:
+                mask.paste(glyph.mask, box[:2], glyph.mask)
+        return TextLine(mask, boxes)
@@ -1,29 +1,65 @@
 import glob
+import hashlib
 import math
+import multiprocessing
 import os
 import pathlib
 import random
+from contextlib import nullcontext
 from random import randint
 from typing import *
 
 import numpy as np
 from PIL import Image, ImageFile, ImageDraw, ImageFilter
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
 from torch.utils.data.dataset import T_co
 
 from recognizer.data import character_sets, fonts
+from recognizer.data.profiling import Profiler
+from recognizer.data.sampling import LabelSampler
+from recognizer.data.text_line import GlyphCache
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+NOT_PROFILING = nullcontext()
 
-def background_images(folder):
+STAGES = 9
+
+
+# Sampling weights of the stages for a fractional stage, e.g. stage 2.25 samples stage 2 75% and stage 3 25% of the time
+def stage_weights(stage: float) -> List[float]:
+    stage = min(max(stage, 0), STAGES - 1)
+    low = math.floor(stage)
+    weights = [0.0] * STAGES
+    weights[low] = 1 - (stage - low)
+    weights[min(low + 1, STAGES - 1)] += stage - low
+    return weights
+
+
+def expected_stage(weights: Sequence[float]) -> float:
+    return sum(stage * weight for stage, weight in enumerate(weights)) / sum(weights)
+
+
+# Sorted, so the same files are loaded in the same order on every machine
+def background_paths(folder) -> List[str]:
     return [
-        Image.open(os.path.join(folder, name))
-        for name in os.listdir(folder)
+        os.path.join(folder, name)
+        for name in sorted(os.listdir(folder))
         if os.path.isfile(os.path.join(folder, name))
     ]
 
 
+def background_images(folder):
+    return [Image.open(path) for path in background_paths(folder)]
+
+
+# Seed of the random generators for one sample of a seeded dataset, in the given iteration over it
+def sample_seed(seed: int, index: int, iteration: int = 0) -> int:
+    key = f"{seed}:{index}" if iteration == 0 else f"{seed}:{iteration}:{index}"
+    digest = hashlib.blake2b(key.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'little')
+
+
 def random_color():
     return randint(0, 255), randint(0, 255), randint(0, 255)
 
@@ -36,31 +72,31 @@ def random_noise(width, height):
     return Image.fromarray(np.random.randint(0, 255, (width, height, 3), dtype=np.dtype('uint8')))
 
 
-def draw_outlined_text(drawing, xy, *args, outline_fill=None, outline_thickness=None, fill, **kwargs):
+# Rasterized text is outlined by dilating its mask, instead of drawing it at every offset within the outline thickness
+def draw_outlined_mask(drawing, xy, mask, outline_fill=None, outline_thickness=None, *, fill):
     if outline_fill is None:
         outline_fill = random_color()
     if outline_thickness is None:
         outline_thickness = 1 + round(abs(np.random.normal(1)))
 
     x, y = xy
-    for dx in range(-outline_thickness, 1 + outline_thickness):
-        for dy in range(-outline_thickness, 1 + outline_thickness):
-            drawing.text((x + dx, y + dy), *args, fill=outline_fill, **kwargs)
-
-    drawing.text(xy, *args, fill=fill, **kwargs)
+    margin = outline_thickness
+    padded = mask.crop((-margin, -margin, mask.width + margin, mask.height + margin))
+    outline = padded.filter(ImageFilter.MaxFilter(2 * outline_thickness + 1))
 
+    drawing.bitmap((x - margin, y - margin), outline, fill=outline_fill)
+    drawing.bitmap((x, y), mask, fill=fill)
 
-def draw_underlined_text(drawing, xy, text, *args, font, anchor, language, **kwargs):
-    left, top, right, bottom = font.getbbox(text, anchor=anchor, language=language)
 
+def draw_underlined_mask(drawing, xy, mask, *, font_size, fill):
     width = round(abs(np.random.normal(1, 0.1)))
-    jitter = np.random.normal(1, 0.1) * (font.size / 20)
-    drawing.text(xy, text, *args, font=font, anchor=anchor, language=language, **kwargs)
+    jitter = np.random.normal(1, 0.1) * (font_size / 20)
+    drawing.bitmap(xy, mask, fill=fill)
     x, y = xy
     drawing.line((
-        (x + left, y + bottom + jitter),
-        (x + right, y + bottom + jitter)
-    ), *args, width=width, **kwargs)
+        (x, y + mask.height + jitter),
+        (x + mask.width, y + mask.height + jitter)
+    ), width=width, fill=fill)
 
 
 def eat_sides(image, left, right, top, bottom):
@@ -94,23 +130,77 @@ def eat_sides(image, left, right, top, bottom):
 
 class RecognizerTrainingDataset(IterableDataset):
     def __init__(self, data_folder: str,
-                 character_set: List[str], transform=None):
+                 character_set: List[str], transform=None, region_score_transform=None):
         super().__init__()
         fonts_folder = os.path.join(data_folder, "fonts")
         background_images_folder = os.path.join(data_folder, "backgrounds")
         self.font_infos = fonts.font_infos_in_folder(fonts_folder, character_set)
         print(f"Found {len(self.font_infos)} fonts")
+        self.fonts_by_glyph: Dict[str, List[fonts.FontInfo]] = {}
+        for font_info in self.font_infos:
+            for glyph in font_info.renderable():
+                self.fonts_by_glyph.setdefault(glyph, []).append(font_info)
+        # Labels that fail to render at some size in every font are drawn with the fonts that have the glyph at all
+        for character in character_set:
+            if character not in self.fonts_by_glyph:
+                supporting = [font_info for font_info in self.font_infos if character in font_info.supported_glyphs]
+                if not supporting:
+                    raise ValueError(f"No font in {fonts_folder} has a glyph for the label '{character}'")
+                print(f"'{character}' does not render at every size in any font, drawing it with the {len(supporting)} "
+                      f"fonts having it")
+                self.fonts_by_glyph[character] = supporting
         self.transform = transform
+        self.region_score_transform = region_score_transform if region_score_transform is not None else transform
         self.characters = character_set
-        self.background_images = [
-            Image.open(os.path.join(background_images_folder, name))
-            for name in os.listdir(background_images_folder)
-            if os.path.isfile(os.path.join(background_images_folder, name))
-        ]
+        self.background_images = background_images(background_images_folder)
+        # Shared memory, so changes to the curriculum reach DataLoader workers and generation processes while they run
+        self.stage_weights = multiprocessing.Array('d', STAGES, lock=False)
         self.stage = 0
+        # Uniform unless weighted by recognizer.data.hard_examples.HardExampleMining
+        self.label_sampler = LabelSampler(len(character_set))
+        self.profiler: Optional[Profiler] = None
+        self.glyph_cache = GlyphCache()
+        # With a seed, sample i is generated from random generators seeded from the seed and i, so the stream of
+        # samples is the same on every run, see recognizer.data.snapshot
+        self.seed: Optional[int] = None
+        # Iterations started over a seeded dataset by all DataLoader workers, so every epoch gets new samples
+        self.iterations = multiprocessing.Value('q', 0)
+        # DataLoader workers take turns generating whole batches, set to the batch size of the DataLoader
+        self.batch_size = 1
+
+    # With custom stage weights, this is the expected stage of a sample
+    @property
+    def stage(self) -> float:
+        return expected_stage(self.stage_weights)
+
+    @stage.setter
+    def stage(self, stage: float):
+        self.stage_weights[:] = stage_weights(stage)
+
+    # Shared memory can only be inherited by forked processes, pickled copies get their own weights
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['stage_weights'] = list(self.stage_weights)
+        state['iterations'] = self.iterations.value
+        return state
+
+    def __setstate__(self, state):
+        weights = state.pop('stage_weights')
+        iterations = state.pop('iterations')
+        self.__dict__.update(state)
+        self.stage_weights = multiprocessing.Array('d', weights, lock=False)
+        self.iterations = multiprocessing.Value('q', iterations)
+
+    def profile(self, name):
+        if self.profiler is None:
+            return NOT_PROFILING
+        return self.profiler.phase(name)
+
+    def random_label(self) -> int:
+        return self.label_sampler.sample()
 
     def fonts_supporting_glyph(self, glyph):
-        return [font for font in self.font_infos if glyph in font.supported_glyphs]
+        return self.fonts_by_glyph.get(glyph, [])
 
     def random_background_image(self, width, height):
         background = random.choice(self.background_images)
@@ -159,6 +249,16 @@ class RecognizerTrainingDataset(IterableDataset):
         kwargs['fill'] = (255,)
         drawing = ImageDraw.Draw(region_score)
         drawing.text(*args, **kwargs)
+        return RecognizerTrainingDataset.region_score_from_char(region_score)
+
+    @staticmethod
+    def generate_only_mask(xy, mask):
+        region_score = Image.new('L', (128, 128), color=(0,))
+        region_score.paste(mask, xy)
+        return RecognizerTrainingDataset.region_score_from_char(region_score)
+
+    @staticmethod
+    def region_score_from_char(region_score):
         region_score = region_score.filter(ImageFilter.MaxFilter(19))
         region_score = region_score.filter(ImageFilter.MinFilter(17))
         # kwargs['fill'] = (255,)
@@ -178,384 +278,371 @@ class RecognizerTrainingDataset(IterableDataset):
 
     # Generates very simple fixed size characters black on white
     def generate_stage_0(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = self.fonts_supporting_glyph(character)[0]
-        font_size = 32
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = self.fonts_supporting_glyph(character)[0]
+            font_size = 32
+            font = font_info.get(font_size)
 
-        _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
+        with self.profile("getbbox"):
+            _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
         sample = Image.new('RGB', (128, 128), color=WHITE_COLOR)
         drawing = ImageDraw.Draw(sample)
-        drawing.text((64, 64), character, font=font, fill=BLACK_COLOR, anchor='mm', language='ja')
-
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 - width / 2, 64 - height / 2),
-            bottom_right=(64 + width / 2, 64 + height / 2),
-        )
-        region_score = self.generate_only_char((64, 64), character, font=font, fill=BLACK_COLOR, anchor='mm',
-                                               language='ja')
+        with self.profile("text_draw"):
+            drawing.text((64, 64), character, font=font, fill=BLACK_COLOR, anchor='mm', language='ja')
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=(64 - width / 2, 64 - height / 2),
+                bottom_right=(64 + width / 2, 64 + height / 2),
+            )
+            region_score = self.generate_only_char((64, 64), character, font=font, fill=BLACK_COLOR, anchor='mm',
+                                                   language='ja')
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # 50/50 chance between black on white and white on black
     def generate_stage_1(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = self.fonts_supporting_glyph(character)[0]
-        font_size = 32
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = self.fonts_supporting_glyph(character)[0]
+            font_size = 32
+            font = font_info.get(font_size)
         inverted = random.random() > 0.5
 
-        _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
+        with self.profile("getbbox"):
+            _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
         sample = Image.new('RGB', (128, 128), color=BLACK_COLOR if inverted else WHITE_COLOR)
         drawing = ImageDraw.Draw(sample)
-        drawing.text((64, 64), character, font=font, fill=WHITE_COLOR if inverted else BLACK_COLOR, anchor='mm',
-                     language='ja')
-
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 - width / 2, 64 - height / 2),
-            bottom_right=(64 + width / 2, 64 + height / 2),
-        )
-        region_score = self.generate_only_char((64, 64), character, font=font,
-                                               fill=WHITE_COLOR if inverted else BLACK_COLOR, anchor='mm',
-                                               language='ja')
+        with self.profile("text_draw"):
+            drawing.text((64, 64), character, font=font, fill=WHITE_COLOR if inverted else BLACK_COLOR, anchor='mm',
+                         language='ja')
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=(64 - width / 2, 64 - height / 2),
+                bottom_right=(64 + width / 2, 64 + height / 2),
+            )
+            region_score = self.generate_only_char((64, 64), character, font=font,
+                                                   fill=WHITE_COLOR if inverted else BLACK_COLOR, anchor='mm',
+                                                   language='ja')
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # Colors are now random
     def generate_stage_2(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = self.fonts_supporting_glyph(character)[0]
-        font_size = 32
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = self.fonts_supporting_glyph(character)[0]
+            font_size = 32
+            font = font_info.get(font_size)
 
-        _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
+        with self.profile("getbbox"):
+            _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
         sample = Image.new('RGB', (128, 128), color=random_color())
         drawing = ImageDraw.Draw(sample)
-        drawing.text((64, 64), character, font=font, fill=random_color(), anchor='mm', language='ja')
+        with self.profile("text_draw"):
+            drawing.text((64, 64), character, font=font, fill=random_color(), anchor='mm', language='ja')
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=(64 - width / 2, 64 - height / 2),
+                bottom_right=(64 + width / 2, 64 + height / 2),
+            )
+            region_score = self.generate_only_char((64, 64), character, font=font, fill=random_color(), anchor='mm',
+                                                   language='ja')
 
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 - width / 2, 64 - height / 2),
-            bottom_right=(64 + width / 2, 64 + height / 2),
-        )
-        region_score = self.generate_only_char((64, 64), character, font=font, fill=random_color(), anchor='mm',
-                                               language='ja')
-
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # Font sizes can now vary between two sizes
     def generate_stage_3(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = self.fonts_supporting_glyph(character)[0]
-        font_size = random.choice([20, 32])
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = self.fonts_supporting_glyph(character)[0]
+            font_size = random.choice([20, 32])
+            font = font_info.get(font_size)
 
-        _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
+        with self.profile("getbbox"):
+            _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
         sample = Image.new('RGB', (128, 128), color=random_color())
         drawing = ImageDraw.Draw(sample)
-        drawing.text((64, 64), character, font=font, fill=random_color(), anchor='mm', language='ja')
-
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 - width / 2, 64 - height / 2),
-            bottom_right=(64 + width / 2, 64 + height / 2),
-        )
-        region_score = self.generate_only_char((64, 64), character, font=font, fill=random_color(), anchor='mm',
-                                               language='ja')
+        with self.profile("text_draw"):
+            drawing.text((64, 64), character, font=font, fill=random_color(), anchor='mm', language='ja')
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=(64 - width / 2, 64 - height / 2),
+                bottom_right=(64 + width / 2, 64 + height / 2),
+            )
+            region_score = self.generate_only_char((64, 64), character, font=font, fill=random_color(), anchor='mm',
+                                                   language='ja')
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # Completely random font size, and random font
     def generate_stage_4(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = random.choice(self.fonts_supporting_glyph(character))
-        font_size = self.random_font_size()
-        font_size = max(8, font_size)
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = random.choice(self.fonts_supporting_glyph(character))
+            font_size = self.random_font_size()
+            font_size = max(8, font_size)
+            font = font_info.get(font_size)
 
-        _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
+        with self.profile("getbbox"):
+            _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
         sample = Image.new('RGB', (128, 128), color=random_color())
         drawing = ImageDraw.Draw(sample)
-        drawing.text((64, 64), character, font=font, fill=random_color(), anchor='mm', language='ja')
-
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 - width / 2, 64 - height / 2),
-            bottom_right=(64 + width / 2, 64 + height / 2),
-        )
-        region_score = self.generate_only_char((64, 64), character, font=font, fill=random_color(), anchor='mm',
-                                               language='ja')
+        with self.profile("text_draw"):
+            drawing.text((64, 64), character, font=font, fill=random_color(), anchor='mm', language='ja')
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=(64 - width / 2, 64 - height / 2),
+                bottom_right=(64 + width / 2, 64 + height / 2),
+            )
+            region_score = self.generate_only_char((64, 64), character, font=font, fill=random_color(), anchor='mm',
+                                                   language='ja')
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # Random character location (while making sure at least part of the character is still in the center)
     def generate_stage_5(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = random.choice(self.fonts_supporting_glyph(character))
-        font_size = self.random_font_size()
-        font_size = max(8, font_size)
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = random.choice(self.fonts_supporting_glyph(character))
+            font_size = self.random_font_size()
+            font_size = max(8, font_size)
+            font = font_info.get(font_size)
 
-        _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
+        with self.profile("getbbox"):
+            _, _, width, height = font.getbbox(character, anchor='lt', language='ja')
         x_offset = int(((width / 2) - random.random() * width) * 0.8)
         y_offset = int(((height / 2) - random.random() * height) * 0.8)
 
         sample = Image.new('RGB', (128, 128), color=random_color())
         drawing = ImageDraw.Draw(sample)
-        drawing.text((64 + x_offset, 64 + y_offset), character, font=font, fill=random_color(), anchor='mm',
-                     language='ja')
+        with self.profile("text_draw"):
+            drawing.text((64 + x_offset, 64 + y_offset), character, font=font, fill=random_color(), anchor='mm',
+                         language='ja')
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=(64 + x_offset - width / 2, 64 + y_offset - height / 2),
+                bottom_right=(64 + x_offset + width / 2, 64 + y_offset + height / 2),
+            )
+            region_score = self.generate_only_char((64 + x_offset, 64 + y_offset), character, font=font,
+                                                   fill=random_color(), anchor='mm',
+                                                   language='ja')
 
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 + x_offset - width / 2, 64 + y_offset - height / 2),
-            bottom_right=(64 + x_offset + width / 2, 64 + y_offset + height / 2),
-        )
-        region_score = self.generate_only_char((64 + x_offset, 64 + y_offset), character, font=font,
-                                               fill=random_color(), anchor='mm',
-                                               language='ja')
+        return self.output(sample, label, region_score)
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+    # Places the text line so the character at the given index is centered on the given point,
+    # returns the position of the line and the box of the character
+    @staticmethod
+    def place_line(line, index, center_x, center_y):
+        left, top, right, bottom = line.boxes[index]
+        x = round(center_x - (left + right) / 2)
+        y = round(center_y - (top + bottom) / 2)
+        return (x, y), (x + left, y + top, x + right, y + bottom)
 
     # Characters before and after, simulating a sentence
     def generate_stage_6(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = random.choice(self.fonts_supporting_glyph(character))
-        font_size = self.random_font_size()
-        font_size = max(8, font_size)
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = random.choice(self.fonts_supporting_glyph(character))
+            font_size = self.random_font_size()
+            font_size = max(8, font_size)
+            font = font_info.get(font_size)
 
+        glyphs = font_info.renderable(font_size)
         before_count = random.randint(0, 10)
         after_count = random.randint(0, 10)
-        total_count = before_count + after_count + 1
-        before = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(before_count)]
-        after = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(after_count)]
+        before = [random.choice(glyphs) for _ in range(before_count)]
+        after = [random.choice(glyphs) for _ in range(after_count)]
         text = ''.join(before) + character + ''.join(after)
 
-        for extra_character in list(text):
-            left, top, right, bottom = font.getbbox(extra_character, anchor='lt', language='ja')
-            if right == 0 or bottom == 0:
-                print(f"'{extra_character}' is missing from {os.path.basename(font_info['path'])}")
-                exit(-1)
-
-        left, top, right, bottom = font.getbbox(text, anchor='lt', language='ja')
+        with self.profile("text_layout"):
+            line = self.glyph_cache.render_line(font, text)
 
-        character_width = right / total_count
-        character_height = bottom
-        x = 64 - character_width / 2 - character_width * before_count
+        left, top, right, bottom = line.boxes[before_count]
+        character_width = right - left
+        character_height = bottom - top
         x_offset = int(((character_width / 2) - random.random() * character_width) * 0.8)
         y_offset = int(((character_height / 2) - random.random() * character_height) * 0.8)
+        xy, character_box = self.place_line(line, before_count, 64 + x_offset, 64 + y_offset)
 
         sample = Image.new('RGB', (128, 128), color=random_color())
         drawing = ImageDraw.Draw(sample)
-        drawing.text((x + x_offset, 64 + y_offset), text, font=font, fill=random_color(), anchor='lm', language='ja')
-
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 + x_offset - character_width / 2, 64 + y_offset - character_width / 2),
-            bottom_right=(64 + x_offset + character_width / 2, 64 + y_offset + character_width / 2),
-        )
-        region_score = self.generate_only_char((64 + x_offset, 64 + y_offset), character, font=font,
-                                               fill=random_color(),
-                                               anchor='mm', language='ja')
+        with self.profile("text_draw"):
+            drawing.bitmap(xy, line.mask, fill=random_color())
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=character_box[:2],
+                bottom_right=character_box[2:],
+            )
+            region_score = self.generate_only_mask(character_box[:2], self.glyph_cache.glyph(font, character).mask)
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # Borders, cropping the sides of the images, real images used as background with gaussian noise
     def generate_stage_7(self):
-        label = random.randrange(0, len(self.characters))
+        label = self.random_label()
         character = self.characters[label]
-        font_info = random.choice(self.fonts_supporting_glyph(character))
-        font_size = self.random_font_size()
-        font_size = max(8, font_size)
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = random.choice(self.fonts_supporting_glyph(character))
+            font_size = self.random_font_size()
+            font_size = max(8, font_size)
+            font = font_info.get(font_size)
 
+        glyphs = font_info.renderable(font_size)
         before_count = random.randint(0, 10)
         after_count = random.randint(0, 10)
-        total_count = before_count + after_count + 1
-        before = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(before_count)]
-        after = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(after_count)]
+        before = [random.choice(glyphs) for _ in range(before_count)]
+        after = [random.choice(glyphs) for _ in range(after_count)]
         text = ''.join(before) + character + ''.join(after)
 
-        for extra_character in list(text):
-            left, top, right, bottom = font.getbbox(extra_character, anchor='lt', language='ja')
-            if right == 0 or bottom == 0:
-                print(f"{extra_character} is missing from {os.path.basename(font_info.path)}")
-                exit(-1)
+        with self.profile("text_layout"):
+            line = self.glyph_cache.render_line(font, text)
 
-        left, top, right, bottom = font.getbbox(text, anchor='lt', language='ja')
-
-        character_width = right / total_count
-        character_height = bottom
-        x = 64 - character_width / 2 - character_width * before_count
+        left, top, right, bottom = line.boxes[before_count]
+        character_width = right - left
+        character_height = bottom - top
         x_offset = int(((character_width / 2) - random.random() * character_width) * 0.8)
         y_offset = int(((character_height / 2) - random.random() * character_height) * 0.8)
+        xy, character_box = self.place_line(line, before_count, 64 + x_offset, 64 + y_offset)
 
-        sample = self.generate_background(128, 128)
+        with self.profile("background"):
+            sample = self.generate_background(128, 128)
         drawing = ImageDraw.Draw(sample)
 
-        if random.random() > 0.9:
-            draw_outlined_text(drawing, (x + x_offset, 64 + y_offset),
-                               text, font=font, fill=random_color(), anchor='lm', language='ja')
-        else:
-            drawing.text((x + x_offset, 64 + y_offset),
-                         text, font=font, fill=random_color(), anchor='lm', language='ja')
+        with self.profile("text_draw"):
+            if random.random() > 0.9:
+                draw_outlined_mask(drawing, xy, line.mask, fill=random_color())
+            else:
+                drawing.bitmap(xy, line.mask, fill=random_color())
 
         if random.random() > 0.9:
-            eat_sides(
-                sample,
-                64 + x_offset - character_width / 2,
-                64 + x_offset + character_width / 2,
-                64 + y_offset - character_height / 2,
-                64 + y_offset + character_height / 2
-            )
+            eat_sides(sample, character_box[0], character_box[2], character_box[1], character_box[3])
 
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 + x_offset - character_width / 2, 64 + y_offset - character_width / 2),
-            bottom_right=(64 + x_offset + character_width / 2, 64 + y_offset + character_width / 2),
-        )
-        region_score = self.generate_only_char((64 + x_offset, 64 + y_offset),
-                                               character, font=font, fill=random_color(), anchor='mm', language='ja')
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=character_box[:2],
+                bottom_right=character_box[2:],
+            )
+            region_score = self.generate_only_mask(character_box[:2], self.glyph_cache.glyph(font, character).mask)
 
-        if self.transform is None:
-            return sample, label, region_score
-        else:
-            return self.transform(sample), label, self.transform(region_score)
+        return self.output(sample, label, region_score)
 
     # Characters placed randomly on the screen, underlined text
     def generate_stage_8(self):
-        character_index = random.randrange(0, len(self.characters))
+        character_index = self.random_label()
         character = self.characters[character_index]
-        font_info = random.choice(self.fonts_supporting_glyph(character))
-        font_size = self.random_font_size()
-        font_size = max(8, font_size)
-        font = font_info.get(font_size)
+        with self.profile("font_lookup"):
+            font_info = random.choice(self.fonts_supporting_glyph(character))
+            font_size = self.random_font_size()
+            font_size = max(8, font_size)
+            font = font_info.get(font_size)
 
+        glyphs = font_info.renderable(font_size)
         before_count = random.randint(0, 10)
         after_count = random.randint(0, 10)
-        total_count = before_count + after_count + 1
-        before = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(before_count)]
-        after = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(after_count)]
+        before = [random.choice(glyphs) for _ in range(before_count)]
+        after = [random.choice(glyphs) for _ in range(after_count)]
         text = ''.join(before) + character + ''.join(after)
 
         floating_count = int(abs(np.random.normal(0, 10)))
-        floating_characters = [random.choice(tuple(font_info.supported_glyphs)) for _ in range(floating_count)]
+        floating_characters = [random.choice(font_info.renderable()) for _ in range(floating_count)]
 
-        for extra_character in list(text) + floating_characters:
-            left, top, right, bottom = font.getbbox(extra_character, anchor='lt', language='ja')
-            if right == 0 or bottom == 0:
-                print(f"{extra_character} is missing from {os.path.basename(font_info.path)}")
-                exit(-1)
+        with self.profile("text_layout"):
+            line = self.glyph_cache.render_line(font, text)
 
-        left, top, right, bottom = font.getbbox(text, anchor='lt', language='ja')
-
-        character_width = right / total_count
-        character_height = bottom
-        x = 64 - character_width / 2 - character_width * before_count
+        left, top, right, bottom = line.boxes[before_count]
+        character_width = right - left
+        character_height = bottom - top
         x_offset = int(((character_width / 2) - random.random() * character_width) * 0.8)
         y_offset = int(((character_height / 2) - random.random() * character_height) * 0.8)
-        x = x + x_offset
-        y = 64 + y_offset
+        xy, character_box = self.place_line(line, before_count, 64 + x_offset, 64 + y_offset)
+        line_top = xy[1]
+        line_bottom = xy[1] + line.mask.height
 
-        sample = self.generate_background(128, 128)
+        with self.profile("background"):
+            sample = self.generate_background(128, 128)
         drawing = ImageDraw.Draw(sample)
 
         effect = random.choices(['outline', 'underline', 'none'], weights=[1, 1, 10])[0]
-        if effect == 'outline':
-            draw_outlined_text(drawing, (x, y), text, font=font, fill=random_color(), anchor='lm', language='ja')
-        elif effect == 'underline':
-            draw_underlined_text(drawing, (x, y), text, font=font, fill=random_color(), anchor='lm', language='ja')
-        else:
-            drawing.text((x, y), text, font=font, fill=random_color(), anchor='lm', language='ja')
+        with self.profile("text_draw"):
+            if effect == 'outline':
+                draw_outlined_mask(drawing, xy, line.mask, fill=random_color())
+            elif effect == 'underline':
+                draw_underlined_mask(drawing, xy, line.mask, font_size=font.size, fill=random_color())
+            else:
+                drawing.bitmap(xy, line.mask, fill=random_color())
 
         for floating_character in floating_characters:
-            font_info = random.choice(self.fonts_supporting_glyph(floating_character))
-            font_size = self.random_font_size()
-            font_size = max(8, font_size)
-            floating_font = font_info.get(font_size)
-            f_left, f_top, f_right, f_bottom = floating_font.getbbox(floating_character, anchor='lt', language='ja')
+            with self.profile("font_lookup"):
+                font_info = random.choice(self.fonts_supporting_glyph(floating_character))
+                font_size = self.random_font_size()
+                font_size = max(8, font_size)
+                floating_font = font_info.get(font_size)
+            with self.profile("text_layout"):
+                floating_mask = self.glyph_cache.glyph(floating_font, floating_character).mask
 
             floating_x = []
             floating_y = []
-            if y - bottom / 2 - f_bottom > -f_bottom:
-                floating_y += [random.randint(-f_bottom, y - bottom // 2 - f_bottom)]
-            if 128 > y + bottom / 2:
-                floating_y += [random.randint(y + bottom // 2, 128)]
+            if line_top > 0:
+                floating_y += [random.randint(-floating_mask.height, line_top - floating_mask.height)]
+            if line_bottom < 128:
+                floating_y += [random.randint(line_bottom, 128)]
             if not floating_y:
                 continue
 
-            floating_x += [random.randint(-f_right, 128)]
+            floating_x += [random.randint(-floating_mask.width, 128)]
 
-            if random.random() > 0.9:
-                draw_outlined_text(drawing, (random.choice(floating_x), random.choice(floating_y)), floating_character,
-                                   font=floating_font,
-                                   fill=random_color(), anchor='lt', language='ja')
-            else:
-                drawing.text((random.choice(floating_x), random.choice(floating_y)), floating_character, font=font,
-                             fill=random_color(), anchor='lt', language='ja')
+            with self.profile("text_draw"):
+                if random.random() > 0.9:
+                    draw_outlined_mask(drawing, (random.choice(floating_x), random.choice(floating_y)),
+                                       floating_mask, fill=random_color())
+                else:
+                    drawing.bitmap((random.choice(floating_x), random.choice(floating_y)), floating_mask,
+                                   fill=random_color())
 
         if random.random() > 0.9:
-            eat_sides(
-                sample,
-                64 + x_offset - character_width / 2,
-                64 + x_offset + character_width / 2,
-                64 + y_offset - character_height / 2,
-                64 + y_offset + character_height / 2
+            eat_sides(sample, character_box[0], character_box[2], character_box[1], character_box[3])
+
+        with self.profile("region_score"):
+            region_score = self.generate_region_score(
+                128, 128,
+                top_left=character_box[:2],
+                bottom_right=character_box[2:],
             )
+            region_score = self.generate_only_mask(character_box[:2], self.glyph_cache.glyph(font, character).mask)
 
-        region_score = self.generate_region_score(
-            128, 128,
-            top_left=(64 + x_offset - character_width / 2, 64 + y_offset - character_width / 2),
-            bottom_right=(64 + x_offset + character_width / 2, 64 + y_offset + character_width / 2),
-        )
-        region_score = self.generate_only_char((64 + x_offset, 64 + y_offset), character, font=font,
-                                               fill=random_color(), anchor='mm', language='ja')
+        return self.output(sample, character_index, region_score)
 
+    def output(self, sample, label, region_score):
         if self.transform is None:
-            return sample, character_index, region_score
-        else:
-            return self.transform(sample), character_index, self.transform(region_score)
-
-    def generate(self):
-        low = math.floor(self.stage)
-        high = low + 1
-        if random.random() > self.stage - math.floor(self.stage):
-            stage = low
-        else:
-            stage = high
+            return sample, label, region_score
 
-        stage = min(stage, 8)
+        with self.profile("transform"):
+            return self.transform(sample), label, self.region_score_transform(region_score)
 
+    def generate_stage(self, stage):
         if stage == 0:
             return self.generate_stage_0()
         if stage == 1:
@@ -575,12 +662,45 @@ class RecognizerTrainingDataset(IterableDataset):
         if stage == 8:
             return self.generate_stage_8()
 
+    def generate(self):
+        stage = random.choices(range(STAGES), weights=self.stage_weights)[0]
+
+        if self.profiler is None:
+            return self.generate_stage(stage)
+
+        with self.profiler.phase(f"stage_{stage}"):
+            generated = self.generate_stage(stage)
+        self.profiler.sample_done()
+        return generated
+
+    def generate_seeded(self, index: int, iteration: int = 0):
+        seed = sample_seed(self.seed, index, iteration)
+        random.seed(seed)
+        np.random.seed(seed)
+        return self.generate()
+
     def __iter__(self) -> Iterator[T_co]:
+        if self.seed is None:
+            while True:
+                yield self.generate()
+
+        # Workers generate every num_workers-th batch, in the order the DataLoader takes them, so the stream is the
+        # same with any number of workers. Every worker starts one iteration per epoch, so counting them gives the epoch,
+        # as long as the number of workers stays the same.
+        worker = get_worker_info()
+        batch, step = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        with self.iterations.get_lock():
+            iteration = self.iterations.value // step
+            self.iterations.value += 1
         while True:
-            yield self.generate()
+            for index in range(batch * self.batch_size, (batch + 1) * self.batch_size):
+                yield self.generate_seeded(index, iteration)
+            batch += step
 
     def __getitem__(self, index) -> T_co:
-        return self.generate()
+        if self.seed is None:
+            return self.generate()
+        return self.generate_seeded(index)
 
 
 if __name__ == '__main__':
@@ -8,14 +8,17 @@ from torch.utils.data import Dataset
 from torch.utils.data.dataset import T_co, ConcatDataset
 
 from . import character_sets
+from .validation_pack import PackedValidationDataset, PACK_NAME, folders_unchanged
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 # TODO: Vary size
 class RecognizerValidationSingleImageDataset(Dataset):
-    def __init__(self, path, characters, transform=None):
+    # With return_translation, samples also include the (x, y) offset the image was pasted at
+    def __init__(self, path, characters, transform=None, return_translation=False):
         super().__init__()
         self.transform = transform
+        self.return_translation = return_translation
         self.image_path = pathlib.Path(path)
         self.max_translation = int(self.image_path.with_suffix(".txt").read_text())
         self.character = self.image_path.parent.name
@@ -41,15 +44,30 @@ class RecognizerValidationSingleImageDataset(Dataset):
 
         label = self.characters.index(self.character)
 
-        if self.transform is None:
-            return sample, label
-        else:
-            return self.transform(sample), label
+        if self.transform is not None:
+            sample = self.transform(sample)
 
+        if self.return_translation:
+            return sample, label, (x, y)
+        return sample, label
+
+
+# Uses the packed validation set when the data folder has one and no characters were added or removed since packing.
+# Changes to the images of a character are only found by python -m recognizer.data.validation_pack --verify.
+def dataset_from_folder(data_folder, character_set, transform=None, return_translation=False):
+    pack_path = os.path.join(data_folder, PACK_NAME)
+    if os.path.exists(pack_path):
+        dataset = PackedValidationDataset(pack_path, character_set, transform, return_translation)
+        if folders_unchanged(dataset.sources, data_folder):
+            assert len(dataset) > 0
+            return dataset
+        print(f"{pack_path} is out of date, loading the images instead. "
+              f"Pack them again with python -m recognizer.data.validation_pack")
 
-def dataset_from_folder(data_folder, character_set, transform=None):
     paths = glob.glob(os.path.join(data_folder, "free-kanji", '**/*.png'), recursive=True)
-    datasets = [RecognizerValidationSingleImageDataset(path, character_set, transform) for path in paths]
+    datasets = [
+        RecognizerValidationSingleImageDataset(path, character_set, transform, return_translation) for path in paths
+    ]
     dataset = ConcatDataset(datasets)
     assert len(dataset) > 0
     return dataset
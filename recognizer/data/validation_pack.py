@@ -0,0 +1,240 @@
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+from typing import *
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+from torch.utils.data.dataset import T_co
+
+from recognizer import glyph_scale
+
+MAGIC = b"KANJIVAL"
+ALIGNMENT = 64
+PACK_NAME = "validation.pack"
+# Images of free-kanji are pasted at every translation within their limit, boxed-kanji are tight crops of a character,
+# scaled to the canonical glyph size around their box
+FREE = "free"
+BOXED = "boxed"
+
+
+def load_rgb(path: str) -> np.ndarray:
+    with open(path, 'rb') as file:
+        return np.asarray(Image.open(file).convert('RGB'))
+
+
+# Box (left, top, right, bottom) of the character in a crop, the whole crop if nothing stands out from its border
+def ink_box(pixels: np.ndarray) -> Tuple[int, int, int, int]:
+    mask = glyph_scale.foreground_mask(pixels)
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return 0, 0, pixels.shape[1], pixels.shape[0]
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def source_paths(data_folder: str) -> List[str]:
+    return sorted(
+        path
+        for folder in ["free-kanji", "boxed-kanji"]
+        for extension in ["png", "txt"]
+        for path in glob.glob(os.path.join(data_folder, folder, f"**/*.{extension}"), recursive=True)
+    )
+
+
+# Modification times of the folders of the validation sets, which change when characters are added or removed
+def folder_mtimes(data_folder: str) -> Dict[str, float]:
+    return {
+        folder: os.stat(os.path.join(data_folder, folder)).st_mtime
+        for folder in ["free-kanji", "boxed-kanji"]
+        if os.path.isdir(os.path.join(data_folder, folder))
+    }
+
+
+# Recorded in the header of a pack, a pack with other sources than its data folder is out of date. Comparing the files
+# takes a stat per file, so loading a pack only compares the folders, see `verify`.
+def sources(data_folder: str) -> Dict[str, Any]:
+    paths = source_paths(data_folder)
+    return {
+        "files": len(paths),
+        "max_mtime": max((os.stat(path).st_mtime for path in paths), default=0.0),
+        "folders": folder_mtimes(data_folder),
+    }
+
+
+# Whether the pack is cheaply known to be up to date, for every load
+def folders_unchanged(pack_sources: Optional[Dict[str, Any]], data_folder: str) -> bool:
+    return pack_sources is not None and pack_sources.get("folders") == folder_mtimes(data_folder)
+
+
+# Differences between the sources of a pack and its data folder, empty when it is up to date
+def verify(path: str, data_folder: str) -> List[str]:
+    pack_sources = PackedValidationDataset(path, []).sources
+    if pack_sources is None:
+        return ["the pack was written before sources were recorded"]
+    current = sources(data_folder)
+    return [
+        f"{name}: {pack_sources.get(name)} -> {value}" for name, value in current.items() if pack_sources.get(name) != value
+    ]
+
+
+# Packs free-kanji and boxed-kanji into a single file: a header describing every image, followed by the pixels of all
+# images as one contiguous uint8 array
+def pack(data_folder: str, path: str):
+    entries = []
+    pixels = []
+    offset = 0
+
+    def add(kind: str, image_path: str, max_translation: int, box: Optional[Tuple[int, int, int, int]] = None):
+        nonlocal offset
+        image = load_rgb(image_path)
+        entries.append({
+            "kind": kind,
+            "character": os.path.basename(os.path.dirname(image_path)),
+            "offset": offset,
+            "height": image.shape[0],
+            "width": image.shape[1],
+            "max_translation": max_translation,
+            "box": box or ink_box(image),
+        })
+        pixels.append(image.reshape(-1))
+        offset += image.size
+
+    for image_path in sorted(glob.glob(os.path.join(data_folder, "free-kanji", "**/*.png"), recursive=True)):
+        with open(os.path.splitext(image_path)[0] + ".txt") as file:
+            add(FREE, image_path, int(file.read()))
+    for image_path in sorted(glob.glob(os.path.join(data_folder, "boxed-kanji", "**/*.png"), recursive=True)):
+        add(BOXED, image_path, 0)
+
+    header = json.dumps({"sources": sources(data_folder), "entries": entries}, ensure_ascii=False).encode("utf-8")
+    data_offset = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        file.write(b"\0" * (data_offset - file.tell()))
+        for image in pixels:
+            file.write(image.tobytes())
+    return entries
+
+
+class PackedValidationDataset(Dataset):
+    """The validation images of a file written by `pack`, mapped into memory once.
+
+    Looking up the image of a sample is a lookup in arrays built when opening the file, so startup and iteration do not
+    depend on the number of images. With return_translation, samples also include the (x, y) offset the image was
+    pasted at, (0, 0) for boxed-kanji.
+    """
+
+    def __init__(self, path: str, characters: List[str], transform=None, return_translation: bool = False,
+                 kinds: Sequence[str] = (FREE, BOXED), size: int = 128):
+        super().__init__()
+        self.path = path
+        self.characters = characters
+        self.transform = transform
+        self.return_translation = return_translation
+        self.size = size
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a packed validation set")
+        header_length, = struct.unpack("<Q", bytes(self.data[len(MAGIC):len(MAGIC) + 8]))
+        header_end = len(MAGIC) + 8 + header_length
+        header = json.loads(bytes(self.data[len(MAGIC) + 8:header_end]).decode("utf-8"))
+        entries = header["entries"]
+        # Missing in packs written before sources were recorded
+        self.sources = header.get("sources")
+        self.data_offset = -(-header_end // ALIGNMENT) * ALIGNMENT
+
+        self.kinds = [entry["kind"] for entry in entries]
+        self.offsets = np.array([entry["offset"] for entry in entries], dtype=np.int64)
+        self.shapes = np.array([(entry["height"], entry["width"]) for entry in entries], dtype=np.int64)
+        self.max_translations = np.array([entry["max_translation"] for entry in entries], dtype=np.int64)
+        self.boxes = [tuple(entry["box"]) for entry in entries]
+        self.labels = np.array([
+            characters.index(entry["character"]) if entry["character"] in characters else -1 for entry in entries
+        ], dtype=np.int64)
+
+        counts = np.array([
+            0 if label < 0 or kind not in kinds else (2 * max_translation) ** 2 if kind == FREE else 1
+            for kind, label, max_translation in zip(self.kinds, self.labels, self.max_translations)
+        ], dtype=np.int64)
+        self.entry_of_sample = np.repeat(np.arange(len(entries)), counts)
+        self.first_sample = np.cumsum(counts) - counts
+
+    # The memory map is opened again by every DataLoader worker, instead of copying the pixels to them
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.entry_of_sample)
+
+    def image(self, entry: int) -> np.ndarray:
+        height, width = self.shapes[entry]
+        start = self.data_offset + self.offsets[entry]
+        return self.data[start:start + height * width * 3].reshape(height, width, 3)
+
+    # Same as pasting the image on a white sample with PIL, parts outside the sample are cut off
+    def paste(self, image: np.ndarray, x: int, y: int) -> np.ndarray:
+        sample = np.full((self.size, self.size, 3), 255, dtype=np.uint8)
+        height, width = image.shape[:2]
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + width, self.size), min(y + height, self.size)
+        if right > left and bottom > top:
+            sample[top:bottom, left:right] = image[top - y:bottom - y, left - x:right - x]
+        return sample
+
+    def __getitem__(self, index) -> T_co:
+        entry = self.entry_of_sample[index]
+        image = self.image(entry)
+        if self.kinds[entry] == FREE:
+            max_translation = int(self.max_translations[entry])
+            within = index - self.first_sample[entry]
+            x = max_translation - int(within % (max_translation * 2))
+            y = max_translation - int(within // (max_translation * 2))
+            sample = self.paste(image, x, y)
+        else:
+            x, y = 0, 0
+            sample = glyph_scale.crop_box_pixels(image, self.boxes[entry], self.size, None,
+                                                 glyph_scale.border_median(image))
+        sample = Image.fromarray(sample)
+        label = int(self.labels[entry])
+
+        if self.transform is not None:
+            sample = self.transform(sample)
+
+        if self.return_translation:
+            return sample, label, (x, y)
+        return sample, label
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack the free-kanji and boxed-kanji validation images into one file.")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing validation data (default: data)")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help=f"path of the packed file (default: {PACK_NAME} in the data folder)")
+    parser.add_argument("--verify", action="store_true",
+                        help="check that the images and labels have not changed since packing, instead of packing")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.data_folder, PACK_NAME)
+    if args.verify:
+        problems = verify(output, args.data_folder)
+        for problem in problems:
+            print(problem)
+        print(f"{output} is out of date" if problems else f"{output} is up to date")
+        sys.exit(1 if problems else 0)
+    entries = pack(args.data_folder, output)
+    print(f"Packed {sum(entry['kind'] == FREE for entry in entries)} free-kanji and "
+          f"{sum(entry['kind'] == BOXED for entry in entries)} boxed-kanji images into {output}")
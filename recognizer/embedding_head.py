@@ -0,0 +1,29 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+class EmbeddingHead(nn.Module):
+    """Projects features to an L2 normalized glyph embedding.
+
+    Training uses a cosine softmax against one learned proxy embedding per class. At inference the proxies are not
+    needed, characters are recognized by their nearest reference embeddings, see recognizer/embedding_index.py.
+    """
+
+    def __init__(self, in_features: int, num_classes: int, embedding_dim: int = 256, scale: float = 16.0):
+        super().__init__()
+        self.projection = nn.Linear(in_features, embedding_dim)
+        self.proxies = nn.Parameter(torch.randn(num_classes, embedding_dim))
+        self.scale = scale
+
+    def forward(self, features):
+        return F.normalize(self.projection(features), dim=1)
+
+    def logits(self, embeddings):
+        return self.scale * embeddings @ F.normalize(self.proxies, dim=1).t()
+
+    def loss(self, features, labels, reduction='mean'):
+        return F.cross_entropy(self.logits(self(features)), labels, reduction=reduction)
+
+    def predict(self, features):
+        return torch.argmax(self.logits(self(features)), dim=1)
@@ -0,0 +1,181 @@
+import argparse
+import json
+import pathlib
+from typing import *
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+from recognizer.data import character_sets, fonts
+from recognizer.data.input_format import image_transform, model_input_format
+
+
+class EmbeddingIndex:
+    """Nearest neighbour index over L2 normalized embeddings, labelled with the character each one was rendered from.
+
+    Without centroids every query is compared against all embeddings. With centroids (an inverted file index) the
+    embeddings are stored grouped by their nearest centroid, and a query is only compared against the embeddings of
+    the `probes` nearest centroids. Saved indexes are memory-mapped when loaded.
+    """
+
+    def __init__(self, embeddings: np.ndarray, labels: List[str],
+                 centroids: Optional[np.ndarray] = None, list_offsets: Optional[np.ndarray] = None):
+        self.embeddings = embeddings
+        self.labels = labels
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+
+    @staticmethod
+    def build(embeddings: np.ndarray, labels: List[str], lists: int = 0, iterations: int = 10) -> 'EmbeddingIndex':
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if lists == 0:
+            return EmbeddingIndex(embeddings, labels)
+
+        centroids, assignments = spherical_k_means(embeddings, lists, iterations)
+        order = np.argsort(assignments, kind='stable')
+        list_offsets = np.searchsorted(assignments[order], np.arange(lists + 1))
+        return EmbeddingIndex(embeddings[order], [labels[i] for i in order], centroids, list_offsets)
+
+    def save(self, folder: str):
+        folder = pathlib.Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        np.save(folder / "embeddings.npy", self.embeddings)
+        (folder / "labels.json").write_text(json.dumps(self.labels, ensure_ascii=False), encoding="utf-8")
+        if self.centroids is not None:
+            np.save(folder / "centroids.npy", self.centroids)
+            np.save(folder / "list_offsets.npy", self.list_offsets)
+
+    @staticmethod
+    def load(folder: str) -> 'EmbeddingIndex':
+        folder = pathlib.Path(folder)
+        embeddings = np.load(folder / "embeddings.npy", mmap_mode='r')
+        labels = json.loads((folder / "labels.json").read_text(encoding="utf-8"))
+        if not (folder / "centroids.npy").exists():
+            return EmbeddingIndex(embeddings, labels)
+        return EmbeddingIndex(
+            embeddings, labels, np.load(folder / "centroids.npy"), np.load(folder / "list_offsets.npy")
+        )
+
+    # Returns the k most similar distinct characters with their cosine similarity, for every query
+    def search(self, queries: np.ndarray, k: int = 5, probes: int = 8) -> List[List[Tuple[str, float]]]:
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        return [self.search_one(query, k, probes) for query in queries]
+
+    def search_one(self, query: np.ndarray, k: int, probes: int) -> List[Tuple[str, float]]:
+        if self.centroids is None:
+            candidates = np.arange(len(self.embeddings))
+            similarities = self.embeddings @ query
+        else:
+            nearest_lists = np.argsort(self.centroids @ query)[::-1][:probes]
+            candidates = np.concatenate([
+                np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in nearest_lists
+            ])
+            similarities = self.embeddings[candidates] @ query
+
+        # Several references may be rendered from the same character, so look further than k for distinct ones
+        count = min(len(candidates), k * 8)
+        if count == 0:
+            # All of the probed lists are empty
+            return []
+        best = np.argpartition(-similarities, count - 1)[:count]
+        best = best[np.argsort(-similarities[best])]
+
+        results = []
+        seen = set()
+        for i in best:
+            label = self.labels[candidates[i]]
+            if label not in seen:
+                seen.add(label)
+                results.append((label, float(similarities[i])))
+                if len(results) == k:
+                    break
+        return results
+
+
+def spherical_k_means(embeddings: np.ndarray, clusters: int, iterations: int, chunk_size: int = 65536):
+    generator = np.random.default_rng(0)
+    centroids = embeddings[generator.choice(len(embeddings), clusters, replace=False)].copy()
+    assignments = np.zeros(len(embeddings), dtype=np.int64)
+    for _ in range(iterations):
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = embeddings[start:start + chunk_size]
+            assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, embeddings)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    return centroids.astype(np.float32), assignments
+
+
+# Reference glyphs are rendered like the first curriculum stage, black on white in the center of the image
+def render_reference(font, character):
+    image = Image.new('RGB', (128, 128), color=(255, 255, 255))
+    ImageDraw.Draw(image).text((64, 64), character, font=font, fill=(0, 0, 0), anchor='mm', language='ja')
+    return image
+
+
+def references(font_infos, characters, fonts_per_character, font_size=32):
+    renderable = [(font_info, set(font_info.renderable())) for font_info in font_infos]
+    for character in characters:
+        supporting = [font_info for font_info, glyphs in renderable if character in glyphs]
+        for font_info in supporting[:fonts_per_character]:
+            yield character, render_reference(font_info.get(font_size), character)
+
+
+@torch.no_grad()
+def embed(model, images: List[Image.Image]) -> np.ndarray:
+    transform = image_transform(*model_input_format(model))
+    batch = torch.stack([transform(image) for image in images]).to(model.device)
+    return model(batch).cpu().numpy()
+
+
+if __name__ == '__main__':
+    from recognizer.model import KanjiRecognizer
+
+    parser = argparse.ArgumentParser(description="Build or query a nearest neighbour index of glyph embeddings.")
+    parser.add_argument("command", choices=["build", "query"])
+    parser.add_argument("-m", "--model-path", type=str, required=True,
+                        help="path to a checkpoint trained with classifier=embedding")
+    parser.add_argument("-i", "--index-path", type=str, required=True,
+                        help="folder the index is saved to or loaded from")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing fonts (default: data)")
+    parser.add_argument("--character-set-name", type=str, default="frequent_kanji_plus",
+                        choices=character_sets.registry.keys(),
+                        help="characters to render references for (default: frequent_kanji_plus)")
+    parser.add_argument("--fonts-per-character", type=int, default=3,
+                        help="references rendered per character (default: 3)")
+    parser.add_argument("--lists", type=int, default=0,
+                        help="number of inverted lists, 0 builds a flat index (default: 0)")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("images", type=str, nargs="*", help="images to look up with the query command")
+    args = parser.parse_args()
+
+    model = KanjiRecognizer.load_from_checkpoint(args.model_path)
+    model.eval()
+
+    if args.command == "build":
+        characters = character_sets.registry[args.character_set_name]
+        font_infos = fonts.font_infos_in_folder(f"{args.data_folder}/fonts", characters)
+        labels = []
+        embeddings = []
+        batch = []
+        for character, image in references(font_infos, characters, args.fonts_per_character):
+            labels.append(character)
+            batch.append(image)
+            if len(batch) == args.batch_size:
+                embeddings.append(embed(model, batch))
+                batch = []
+        if batch:
+            embeddings.append(embed(model, batch))
+
+        index = EmbeddingIndex.build(np.concatenate(embeddings), labels, lists=args.lists)
+        index.save(args.index_path)
+        print(f"Saved {len(labels)} references of {len(set(labels))} characters to {args.index_path}")
+    else:
+        index = EmbeddingIndex.load(args.index_path)
+        queries = embed(model, [Image.open(path).convert('RGB') for path in args.images])
+        for path, results in zip(args.images, index.search(queries)):
+            print(path, " ".join(f"{character} {similarity:.3f}" for character, similarity in results))
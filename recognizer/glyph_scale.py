@@ -0,0 +1,145 @@
+from typing import *
+
+import numpy as np
+from PIL import Image
+
+# Ink extent of the recognized glyph as a fraction of the crop, about a 30px font in a 128x128 sample, which is within
+# the range of sizes the training data generator renders
+GLYPH_FRACTION = 0.2
+
+
+def border_median(pixels: np.ndarray) -> np.ndarray:
+    border = np.concatenate([pixels[0], pixels[-1], pixels[1:-1, 0], pixels[1:-1, -1]])
+    return np.median(border, axis=0)
+
+
+# Foreground is whatever differs clearly from the background, taken as the median of the border of the image
+def foreground_mask(pixels: np.ndarray, threshold: float = 48) -> np.ndarray:
+    difference = np.abs(pixels.astype(np.int16) - border_median(pixels).astype(np.int16))
+    # Reducing the short channel axis with max is several times slower
+    return np.maximum(np.maximum(difference[..., 0], difference[..., 1]), difference[..., 2]) > threshold
+
+
+# The run of occupied indices containing the center, or the nearest run if the center is empty. Runs separated by at
+# most max_gap empty indices are joined, so the strokes of a character form one run.
+def run_around(occupied: np.ndarray, center: int, max_gap: int) -> Optional[Tuple[int, int]]:
+    indices = np.flatnonzero(occupied)
+    if len(indices) == 0:
+        return None
+    breaks = np.flatnonzero(np.diff(indices) > max_gap + 1)
+    starts = indices[np.concatenate([[0], breaks + 1])]
+    ends = indices[np.concatenate([breaks, [len(indices) - 1]])] + 1
+    distances = np.maximum(starts - center, 0) + np.maximum(center + 1 - ends, 0)
+    nearest = np.argmin(distances)
+    return int(starts[nearest]), int(ends[nearest])
+
+
+# Estimates the box (left, top, right, bottom) of the glyph nearest to the center from row and column projections of
+# the foreground. Within a line of text the line height is used as the glyph size.
+def glyph_box(mask: np.ndarray, min_glyph_size: int = 8) -> Optional[Tuple[int, int, int, int]]:
+    height, width = mask.shape
+    rows = run_around(mask.any(axis=1), height // 2, max_gap=max(2, height // 32))
+    if rows is None:
+        return None
+    top, bottom = rows
+    glyph_height = bottom - top
+
+    columns = run_around(mask[top:bottom].any(axis=0), width // 2, max_gap=max(2, glyph_height // 4))
+    left, right = columns
+    if right - left > 1.5 * glyph_height and glyph_height >= min_glyph_size:
+        # A line of text, keep a square around the center the size of the line height
+        center = min(max(width // 2, left + glyph_height // 2), right - glyph_height // 2)
+        left = center - glyph_height // 2
+        right = left + glyph_height
+    return left, top, right, bottom
+
+
+# The pixels of a square window of an image plus a margin, cut off at the edges of the image, and the position of the
+# first of them in the image, a multiple of align
+def window_slice(pixels: np.ndarray, left: float, top: float, window: float, margin: int = 0,
+                 align: int = 1) -> Tuple[np.ndarray, int, int]:
+    height, width = pixels.shape[:2]
+    x0 = min(max(int(np.floor(left)) - margin, 0) // align * align, width)
+    y0 = min(max(int(np.floor(top)) - margin, 0) // align * align, height)
+    x1 = max(min(int(np.ceil(left + window)) + margin, width), x0)
+    y1 = max(min(int(np.ceil(top + window)) + margin, height), y0)
+    return pixels[y0:y1, x0:x1], x0, y0
+
+
+# Resamples a square window of an image to size x size pixels with bilinear interpolation, filling outside the image
+def resample_window(pixels: np.ndarray, left: float, top: float, window: float, size: int,
+                    fill: np.ndarray) -> np.ndarray:
+    factor = int(window // size)
+    # Only the window is resampled, with a margin for the neighbours of the pixels at its edges. The blocks stay aligned
+    # to the image, as if it was resampled whole.
+    pixels, x0, y0 = window_slice(pixels, left, top, window, margin=max(factor, 1) + 1, align=max(factor, 1))
+    left, top = left - x0, top - y0
+    if min(pixels.shape[:2]) < max(factor, 1):
+        # Not a single block of the image in the window
+        return np.broadcast_to(np.clip(np.rint(fill), 0, 255).astype(np.uint8), (size, size, pixels.shape[2])).copy()
+    # Average whole blocks of pixels first when shrinking, bilinear interpolation alone would alias
+    if factor > 1:
+        height = pixels.shape[0] // factor * factor
+        width = pixels.shape[1] // factor * factor
+        blocks = pixels[:height, :width].reshape(height // factor, factor, width // factor, factor, -1)
+        pixels = blocks.mean(axis=(1, 3), dtype=np.float32)
+        left, top, window = left / factor, top / factor, window / factor
+
+    coordinates = (np.arange(size) + 0.5) * (window / size) - 0.5
+    xs = left + coordinates
+    ys = top + coordinates
+    x0 = np.floor(xs).astype(np.int64)
+    y0 = np.floor(ys).astype(np.int64)
+    wx = (xs - x0).astype(np.float32)[None, :, None]
+    wy = (ys - y0).astype(np.float32)[:, None, None]
+
+    height, width = pixels.shape[:2]
+    x0c, x1c = np.clip(x0, 0, width - 1), np.clip(x0 + 1, 0, width - 1)
+    y0c, y1c = np.clip(y0, 0, height - 1), np.clip(y0 + 1, 0, height - 1)
+    top_row = pixels[np.ix_(y0c, x0c)] * (1 - wx) + pixels[np.ix_(y0c, x1c)] * wx
+    bottom_row = pixels[np.ix_(y1c, x0c)] * (1 - wx) + pixels[np.ix_(y1c, x1c)] * wx
+    result = top_row * (1 - wy) + bottom_row * wy
+
+    inside = ((ys >= -0.5) & (ys <= height - 0.5))[:, None] & ((xs >= -0.5) & (xs <= width - 0.5))[None, :]
+    result[~inside] = fill
+    return np.clip(np.rint(result), 0, 255).astype(np.uint8)
+
+
+# Crops a box to size x size pixels, centered and scaled so its larger side spans glyph_size pixels, by default
+# GLYPH_FRACTION of the crop
+def crop_box(image: Image.Image, box: Tuple[int, int, int, int], size: int = 128,
+             glyph_size: Optional[float] = None) -> Image.Image:
+    return crop_boxes(image, [box], size, glyph_size)[0]
+
+
+# Crops every box of an image, e.g. the characters of a frame, converting the image only once
+def crop_boxes(image: Image.Image, boxes: Sequence[Tuple[int, int, int, int]], size: int = 128,
+               glyph_size: Optional[float] = None) -> List[Image.Image]:
+    pixels = np.asarray(image.convert('RGB'))
+    return [Image.fromarray(crop_box_pixels(pixels, box, size, glyph_size)) for box in boxes]
+
+
+# Without a fill, the part of the image outside the window does not matter, e.g. the rest of a frame, and the window is
+# filled with the median of its own border
+def crop_box_pixels(pixels: np.ndarray, box: Tuple[int, int, int, int], size: int, glyph_size: Optional[float],
+                    fill: Optional[np.ndarray] = None) -> np.ndarray:
+    if glyph_size is None:
+        glyph_size = GLYPH_FRACTION * size
+    left, top, right, bottom = box
+    extent = max(right - left, bottom - top, 1)
+    window = size * extent / glyph_size
+    window_left = (left + right) / 2 - window / 2
+    window_top = (top + bottom) / 2 - window / 2
+    if fill is None:
+        local = window_slice(pixels, window_left, window_top, window)[0]
+        fill = border_median(local if local.size > 0 else pixels)
+    return resample_window(pixels, window_left, window_top, window, size, fill)
+
+
+# Rescales the glyph nearest to the center of the image to the canonical size, images without a glyph are only resized
+def normalize_glyph_scale(image: Image.Image, size: int = 128, glyph_size: Optional[float] = None) -> Image.Image:
+    pixels = np.asarray(image.convert('RGB'))
+    box = glyph_box(foreground_mask(pixels))
+    if box is None:
+        return Image.fromarray(resample_window(pixels, 0, 0, min(pixels.shape[:2]), size, border_median(pixels)))
+    return Image.fromarray(crop_box_pixels(pixels, box, size, glyph_size))
@@ -0,0 +1,56 @@
+import math
+from typing import *
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+class HierarchicalSoftmax(nn.Module):
+    """Two level softmax, a coarse softmax over groups of classes followed by a fine softmax within each group.
+
+    Character sets are ordered by frequency, so the groups are buckets of consecutive classes with similar frequency.
+    With groups of about sqrt(num_classes) classes, training only needs the scores of every group and of the classes
+    in the labelled group, making the cost per step grow with sqrt(num_classes) instead of num_classes.
+    """
+
+    def __init__(self, in_features: int, num_classes: int, group_size: Optional[int] = None):
+        super().__init__()
+        self.num_classes = num_classes
+        self.group_size = group_size or math.ceil(math.sqrt(num_classes))
+        self.num_groups = math.ceil(num_classes / self.group_size)
+
+        self.coarse = nn.Linear(in_features, self.num_groups)
+        self.fine_weight = nn.Parameter(torch.empty(self.num_groups, self.group_size, in_features))
+        self.fine_bias = nn.Parameter(torch.empty(self.num_groups, self.group_size))
+        # Same initialization as nn.Linear
+        bound = 1 / math.sqrt(in_features)
+        nn.init.uniform_(self.fine_weight, -bound, bound)
+        nn.init.uniform_(self.fine_bias, -bound, bound)
+
+        # The last group is only partially filled if num_classes is not divisible by group_size
+        classes = torch.arange(self.num_groups * self.group_size).view(self.num_groups, self.group_size)
+        self.register_buffer('valid', classes < num_classes)
+
+    def fine_logits(self, features, groups):
+        weight = self.fine_weight[groups]
+        logits = torch.bmm(weight, features.unsqueeze(2)).squeeze(2) + self.fine_bias[groups]
+        return logits.masked_fill(~self.valid[groups], float('-inf'))
+
+    def loss(self, features, labels, reduction='mean'):
+        groups = labels // self.group_size
+        coarse_loss = F.cross_entropy(self.coarse(features), groups, reduction=reduction)
+        fine_loss = F.cross_entropy(self.fine_logits(features, groups), labels % self.group_size, reduction=reduction)
+        return coarse_loss + fine_loss
+
+    # Greedy prediction, the most likely class in the most likely group
+    def predict(self, features):
+        groups = torch.argmax(self.coarse(features), dim=1)
+        return groups * self.group_size + torch.argmax(self.fine_logits(features, groups), dim=1)
+
+    # Log probabilities of every class
+    def forward(self, features):
+        coarse = F.log_softmax(self.coarse(features), dim=1)
+        fine = torch.einsum('bi,gci->bgc', features, self.fine_weight) + self.fine_bias
+        fine = F.log_softmax(fine.masked_fill(~self.valid, float('-inf')), dim=2)
+        return (coarse.unsqueeze(2) + fine).flatten(1)[:, :self.num_classes]
@@ -0,0 +1,78 @@
+import functools
+import math
+from typing import *
+
+import torch
+from PIL import Image
+from torch.nn import functional as F
+from torchvision import transforms
+
+from recognizer.data.input_format import image_transform, model_input_format
+
+
+@functools.lru_cache()
+def to_tensor(input_size: int = 128, channels: int = 3):
+    return transforms.Compose([
+        image_transform(input_size, channels),
+        transforms.Normalize((0.5,) * channels, (0.5,) * channels)
+    ])
+
+
+# Images are expected at the scale of the 128x128 training samples, and resized to the input size of the model
+def preprocess(images: List[Image.Image], input_size: int = 128, channels: int = 3) -> torch.Tensor:
+    transform = to_tensor(input_size, channels)
+    return torch.stack([transform(image.convert('RGB')) for image in images])
+
+
+# Models with classifier="embedding" output embeddings instead of scores of the characters
+def check_classifier(model):
+    if getattr(model, 'hparams', {}).get('classifier') == "embedding":
+        raise ValueError("Models with classifier=embedding recognize characters through "
+                         "recognizer.embedding_index.EmbeddingIndex, not top_k")
+
+
+# The k most likely characters for every image, most likely first
+@torch.no_grad()
+def top_k(model, images: List[Image.Image], characters: List[str], k: int = 5) -> List[List[str]]:
+    check_classifier(model)
+    outputs = model(preprocess(images, *model_input_format(model)))
+    indices = torch.topk(outputs, k, dim=1).indices
+    return [[characters[i] for i in row] for row in indices.tolist()]
+
+
+# Crops for test time augmentation, (dx, dy) shifts of the center and scales of the glyph
+DEFAULT_SHIFTS = ((0, 0), (-12, 0), (12, 0), (0, -12), (0, 12))
+DEFAULT_SCALES = (0.8, 1.0, 1.25)
+
+
+# Size of the area to grab, so every shifted and scaled crop fits inside it
+def grab_size(size: int = 128, shifts=DEFAULT_SHIFTS, scales=DEFAULT_SCALES) -> int:
+    largest_shift = max(max(abs(dx), abs(dy)) for dx, dy in shifts)
+    return math.ceil(size / min(scales)) + 2 * largest_shift
+
+
+# Shifted and rescaled size x size crops around the center of a larger image, scales above 1 enlarge the glyph
+def multi_crop(image: Image.Image, size: int = 128, shifts=DEFAULT_SHIFTS, scales=DEFAULT_SCALES) \
+        -> List[Image.Image]:
+    center_x = image.width / 2
+    center_y = image.height / 2
+    crops = []
+    for scale in scales:
+        window = size / scale
+        for dx, dy in shifts:
+            left = center_x + dx - window / 2
+            top = center_y + dy - window / 2
+            crops.append(image.resize((size, size), Image.BILINEAR, box=(left, top, left + window, top + window)))
+    return crops
+
+
+# The k most likely characters for an image, from the log probabilities averaged over all of its crops, which are
+# recognized in a single batch
+@torch.no_grad()
+def top_k_multi_crop(model, image: Image.Image, characters: List[str], k: int = 5,
+                     shifts=DEFAULT_SHIFTS, scales=DEFAULT_SCALES) -> List[str]:
+    check_classifier(model)
+    outputs = model(preprocess(multi_crop(image, shifts=shifts, scales=scales), *model_input_format(model)))
+    # log_softmax leaves log probabilities from a hierarchical classifier unchanged
+    log_probabilities = F.log_softmax(outputs, dim=1).mean(dim=0)
+    return [characters[i] for i in torch.topk(log_probabilities, k).indices.tolist()]
@@ -2,37 +2,60 @@ import pytorch_lightning as pl
 import torch
 import torchvision
 import wandb
-from torch import optim
+from torch import optim, nn
 from torch.nn import functional as F
 from vit_pytorch import ViT
 
+from recognizer.bottlenecks import resize_bottlenecks
 from recognizer.data import character_sets
+from recognizer.embedding_head import EmbeddingHead
+from recognizer.hierarchical_softmax import HierarchicalSoftmax
+from recognizer.sample_capture import AsyncLogger
 
 
 class KanjiRecognizer(pl.LightningModule):
-    def __init__(self, character_set_name, model_type="resnet", learning_rate=1e-3, **kwargs):
+    def __init__(self, character_set_name, model_type="resnet", learning_rate=1e-3, classifier="flat",
+                 embedding_dim=256, input_size=128, channels=3, bottleneck_widths=None, **kwargs):
         super().__init__()
 
         self.character_set = character_sets.character_sets[character_set_name]
         self.learning_rate = learning_rate
 
         # Set up model
+        # With classifier="hierarchical" the final layer of the model is replaced by a hierarchical softmax,
+        # so the cost per training step stays roughly flat for large character sets.
+        # With classifier="embedding" the model outputs glyph embeddings, recognized through an embedding index.
+        # Samples are input_size x input_size pixels with 1 (grayscale) or 3 (RGB) channels, see
+        # recognizer.data.input_format.
+        self.head = None
         if model_type == "resnet":
             self.model = torchvision.models.resnet152(num_classes=len(self.character_set))
+            if channels != 3:
+                self.model.conv1 = nn.Conv2d(channels, 64, kernel_size=7, stride=2, padding=3, bias=False)
+            # Set in checkpoints saved by recognizer.pruning
+            if bottleneck_widths is not None:
+                resize_bottlenecks(self.model, bottleneck_widths)
+            if classifier != "flat":
+                self.head = self.create_head(classifier, self.model.fc.in_features, embedding_dim)
+                self.model.fc = nn.Identity()
         if model_type == "ViT":
             self.model = ViT(
-                image_size=128,
+                image_size=input_size,
                 # Number of patches. image_size must be divisible by patch_size.
                 # The number of patches is: n = (image_size // patch_size) ** 2 and n must be greater than 16.
-                patch_size=16,
+                patch_size=input_size // 8,
                 num_classes=len(self.character_set),
                 dim=1024,
                 depth=6,
                 heads=16,
                 mlp_dim=2048,
                 dropout=0.1,
-                emb_dropout=0.1
+                emb_dropout=0.1,
+                channels=channels
             )
+            if classifier != "flat":
+                self.head = self.create_head(classifier, 1024, embedding_dim)
+                self.model.mlp_head[-1] = nn.Identity()
 
         # Copy input to hparms
         self.save_hyperparameters()
@@ -42,23 +65,54 @@ class KanjiRecognizer(pl.LightningModule):
         self.val_accuracy = pl.metrics.Accuracy()
         self.test_accuracy = pl.metrics.Accuracy()
 
+    def create_head(self, classifier, in_features, embedding_dim):
+        if classifier == "hierarchical":
+            return HierarchicalSoftmax(in_features, len(self.character_set))
+        if classifier == "embedding":
+            return EmbeddingHead(in_features, len(self.character_set), embedding_dim=embedding_dim)
+        raise ValueError(f"Unknown classifier: {classifier}")
+
+    # Returns logits, log probabilities when using a hierarchical classifier or embeddings when using an embedding
+    # classifier
     def forward(self, x):
-        return self.model(x)
+        if self.head is None:
+            return self.model(x)
+        return self.head(self.model(x))
 
     def configure_optimizers(self):
         return optim.Adam(self.parameters(), lr=self.hparams['learning_rate'])
 
-    def loss(self, images, labels):
-        logits = self(images)
-        loss = F.cross_entropy(logits, labels)
+    # Scores of the classes, also with an embedding classifier, where these are the similarities to the class proxies
+    def class_scores(self, images):
+        outputs = self(images)
+        if isinstance(self.head, EmbeddingHead):
+            return self.head.logits(outputs)
+        return outputs
+
+    def loss(self, images, labels, reduction='mean'):
+        logits = self.class_scores(images)
+        # Also correct for log probabilities, as log_softmax leaves them unchanged
+        loss = F.cross_entropy(logits, labels, reduction=reduction)
         return logits, loss
 
     def training_step(self, batch, batch_index):
         images, labels, _ = batch
-        logits, loss = self.loss(images, labels)
+        if self.head is None:
+            logits, losses = self.loss(images, labels, reduction='none')
+            predictions = F.softmax(logits, dim=1)
+            predicted = torch.argmax(logits, dim=1)
+        else:
+            # With a hierarchical classifier, only the scores of the groups and of the classes in the labelled
+            # groups are computed
+            features = self.model(images)
+            losses = self.head.loss(features, labels, reduction='none')
+            predictions = predicted = self.head.predict(features)
+        loss = losses.mean()
+        # Read by recognizer.data.hard_examples.HardExampleMining
+        self.sample_losses = (labels.detach(), losses.detach(), predicted.detach())
 
         self.log('train/loss', loss)
-        self.log('train/acc_step', self.train_accuracy(F.softmax(logits, dim=1), labels))
+        self.log('train/acc_step', self.train_accuracy(predictions, labels))
 
         return loss
 
@@ -72,12 +126,9 @@ class KanjiRecognizer(pl.LightningModule):
 
         return loss
 
+    # The curriculum is advanced on this metric by recognizer.data.curriculum.Curriculum
     def training_epoch_end(self, *args):
-        dataset = self.train_dataloader().dataset
         self.log('train/acc_epoch', self.train_accuracy, prog_bar=True)
-        if self.train_accuracy.compute() > 0.80:
-            dataset.stage += 0.5
-        self.log('train/stage', dataset.stage, prog_bar=True)
 
     def test_step(self, batch, batch_index):
         images, labels = batch
@@ -93,16 +144,25 @@ class ImagePredictionLogger(pl.Callback):
         images, labels = samples
         self.images = images[:sample_count]
         self.labels = labels[:sample_count]
+        # The samples are only moved to the device once
+        self.device_images = None
+        self.sample_logger = AsyncLogger()
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        images = self.images.to(device=pl_module.device)
+        if self.device_images is None or self.device_images.device != pl_module.device:
+            self.device_images = self.images.to(device=pl_module.device)
+
+        with torch.no_grad():
+            logits = pl_module.class_scores(self.device_images)
+        predictions = torch.argmax(logits, -1).cpu()
+
+        self.sample_logger.submit(log_predictions, trainer.logger.experiment, self.images, predictions, self.labels)
 
-        logits = pl_module(images)
-        predictions = torch.argmax(logits, -1)
 
-        trainer.logger.experiment.log({
-            'examples': [wandb.Image(
-                image,
-                caption=f'Prediction: {prediction}, Label: {label}'
-            ) for image, prediction, label in zip(images, predictions, self.labels)]
-        })
+def log_predictions(experiment, images, predictions, labels):
+    experiment.log({
+        'examples': [wandb.Image(
+            image,
+            caption=f'Prediction: {prediction}, Label: {label}'
+        ) for image, prediction, label in zip(images, predictions, labels)]
+    })
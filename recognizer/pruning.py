@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import time
+from typing import *
+
+import torch
+from torch import nn, optim
+from torch.utils.data import DataLoader
+
+from recognizer.analytics import evaluate
+from recognizer.bottlenecks import bottlenecks, bottleneck_widths, prune_bottleneck
+from recognizer.data import validation_dataset
+from recognizer.data.input_format import image_transform, region_score_transform, model_input_format
+from recognizer.data.training_dataset import RecognizerTrainingDataset, STAGES
+
+
+# Channels with the largest batch norm scales, the channels with small scales contribute little to the output
+def strongest_channels(batch_norm: nn.BatchNorm2d, ratio: float, multiple: int) -> torch.Tensor:
+    channels = len(batch_norm.weight)
+    # Multiples of 8 channels keep the convolutions vectorized on the cpu
+    keep = max(multiple, round(channels * (1 - ratio) / multiple) * multiple)
+    if keep >= channels:
+        return torch.arange(channels)
+    return torch.topk(batch_norm.weight.detach().abs(), keep).indices.sort().values
+
+
+def prune(model: nn.Module, ratio: float, multiple: int = 8):
+    for block in bottlenecks(model):
+        prune_bottleneck(
+            block,
+            strongest_channels(block.bn1, ratio, multiple),
+            strongest_channels(block.bn2, ratio, multiple)
+        )
+
+
+# Multiply-accumulates of one forward pass of a single sample, counted over convolutions and linear layers
+def count_flops(model: nn.Module, input_size: int, channels: int) -> int:
+    flops = 0
+
+    def count(module, inputs, output):
+        nonlocal flops
+        if isinstance(module, nn.Conv2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+            flops += output[0].numel() * kernel
+        elif isinstance(module, nn.Linear):
+            flops += output[0].numel() * module.in_features
+
+    handles = [module.register_forward_hook(count) for module in model.modules()
+               if isinstance(module, (nn.Conv2d, nn.Linear))]
+    with torch.no_grad():
+        model(torch.zeros(1, channels, input_size, input_size))
+    for handle in handles:
+        handle.remove()
+    return flops
+
+
+# Median milliseconds per batch on the cpu
+def cpu_latency(model: nn.Module, input_size: int, channels: int, batch_size: int = 1, runs: int = 20,
+                warmup: int = 3) -> float:
+    images = torch.rand(batch_size, channels, input_size, input_size)
+    times = []
+    with torch.no_grad():
+        for run in range(warmup + runs):
+            start = time.perf_counter()
+            model(images)
+            if run >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+# Short fine-tuning phase on the generated training stream, recovering from the last pruning step
+def fine_tune(model, dataset: RecognizerTrainingDataset, steps: int, batch_size: int, learning_rate: float,
+              num_workers: int):
+    model.train()
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    for step, (images, labels, _) in enumerate(loader):
+        if step >= steps:
+            break
+        _, loss = model.loss(images.to(model.device), labels.to(model.device))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.eval()
+
+
+# Checkpoints of pruned models load with KanjiRecognizer.load_from_checkpoint, like those saved by Lightning
+def save_checkpoint(model, path: str):
+    model.hparams['bottleneck_widths'] = bottleneck_widths(model.model)
+    torch.save({
+        'state_dict': model.state_dict(),
+        'hyper_parameters': dict(model.hparams),
+    }, path)
+
+
+def measure(model, validation, device: torch.device, batch_size: int, num_workers: int) -> Dict[str, Any]:
+    model.cpu()
+    input_size, channels = model_input_format(model)
+    result = {
+        "parameters": sum(parameter.numel() for parameter in model.parameters()),
+        "flops": count_flops(model, input_size, channels),
+        "latency_ms": cpu_latency(model, input_size, channels),
+    }
+    model.to(device)
+    result["accuracy"] = evaluate(model, validation, batch_size, num_workers).accuracy
+    return result
+
+
+if __name__ == '__main__':
+    from recognizer.model import KanjiRecognizer
+
+    parser = argparse.ArgumentParser(description="Prune the channels of a resnet recognizer, fine-tuning in between.")
+    parser.add_argument("-m", "--model-path", type=str, required=True, help="path to a checkpoint")
+    parser.add_argument("-o", "--output-folder", type=str, default="generated/pruned",
+                        help="folder the checkpoint of every step is saved to (default: generated/pruned)")
+    parser.add_argument("--data-folder", type=str, default="data",
+                        help="path to a folder containing fonts, backgrounds and validation data (default: data)")
+    parser.add_argument("--steps", type=int, default=5, help="pruning steps (default: 5)")
+    parser.add_argument("--ratio", type=float, default=0.2,
+                        help="fraction of the remaining inner channels pruned at each step (default: 0.2)")
+    parser.add_argument("--fine-tune-steps", type=int, default=500,
+                        help="training batches after each step (default: 500)")
+    parser.add_argument("--stage", type=float, default=STAGES - 1,
+                        help="curriculum stage of the fine-tuning samples (default: the last)")
+    parser.add_argument("--learning-rate", type=float, default=1e-4)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = KanjiRecognizer.load_from_checkpoint(args.model_path)
+    if model.hparams.get('model_type', 'resnet') != "resnet":
+        parser.error("only resnet models can be pruned")
+    model.eval()
+    model.to(device)
+
+    transform = image_transform(*model_input_format(model))
+    validation = validation_dataset.dataset_from_folder(
+        data_folder=args.data_folder,
+        character_set=model.character_set,
+        transform=transform,
+        return_translation=True
+    )
+    training = RecognizerTrainingDataset(
+        data_folder=args.data_folder,
+        character_set=model.character_set,
+        transform=transform,
+        region_score_transform=region_score_transform()
+    )
+    training.stage = args.stage
+
+    pathlib.Path(args.output_folder).mkdir(parents=True, exist_ok=True)
+    report_path = os.path.join(args.output_folder, "report.jsonl")
+    for step in range(args.steps + 1):
+        if step > 0:
+            model.cpu()
+            prune(model.model, args.ratio)
+            model.to(device)
+            fine_tune(model, training, args.fine_tune_steps, args.batch_size, args.learning_rate, args.num_workers)
+            save_checkpoint(model, os.path.join(args.output_folder, f"step-{step}.ckpt"))
+
+        result = {"step": step, **measure(model, validation, device, args.batch_size, args.num_workers)}
+        print(f"Step {step}: accuracy {result['accuracy']:.4f}, {result['flops'] / 1e9:.2f} GMACs, "
+              f"{result['latency_ms']:.1f} ms, {result['parameters'] / 1e6:.1f}M parameters")
+        with open(report_path, 'a') as file:
+            file.write(json.dumps(result) + "\n")
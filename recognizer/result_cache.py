@@ -0,0 +1,102 @@
+import collections
+import hashlib
+import os
+import shelve
+import time
+from typing import *
+
+import numpy as np
+from PIL import Image
+
+from recognizer import glyph_scale
+
+
+# Hash of the glyph under the center of a crop, standardized so repeated grabs of the same text hash the same. The glyph
+# is scaled to most of the hashed pixels first, a whole grab shrunk to a few pixels per glyph gives similar characters,
+# e.g. 未 and 末, the same hash.
+def crop_hash(image: Image.Image, size: int = 64) -> str:
+    glyph = glyph_scale.normalize_glyph_scale(image, size, glyph_size=0.75 * size)
+    pixels = np.asarray(glyph.convert('L'), dtype=np.float32)
+    pixels = (pixels - pixels.mean()) / (pixels.std() + 1e-6)
+    quantized = np.clip(np.round(pixels * 2) + 8, 0, 15).astype(np.uint8)
+    return hashlib.blake2b(quantized.tobytes(), digest_size=16).hexdigest()
+
+
+# Changes whenever the checkpoint is replaced, without reading the whole file
+def model_version(checkpoint_path: str) -> str:
+    stat = os.stat(checkpoint_path)
+    return f"{os.path.basename(checkpoint_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class RecognitionCache:
+    """LRU cache of recognition results, keyed by model version and crop hash.
+
+    Entries older than `ttl` seconds are treated as missing. With a `spill_path`, entries evicted from memory are
+    written to an on-disk shelve and promoted back into memory when they are hit again.
+    """
+
+    def __init__(self, model_version: str, max_entries: int = 4096, ttl: Optional[float] = None,
+                 spill_path: Optional[str] = None):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: Dict[str, Tuple[float, Any]] = collections.OrderedDict()
+        self.spill = shelve.open(spill_path) if spill_path is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image: Image.Image) -> str:
+        return f"{self.model_version}:{crop_hash(image)}"
+
+    def expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None and self.spill is not None and key in self.spill:
+            entry = self.spill.pop(key)
+            self.entries[key] = entry
+        if entry is None or self.expired(entry[0]):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        # Promoted entries count towards the limit too
+        self.evict()
+        self.hits += 1
+        return entry[1]
+
+    # Entries are stamped with the wall clock rather than a monotonic clock, which restarts with the process, as spilled
+    # entries outlive it
+    def put(self, key: str, value: Any):
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        self.evict()
+
+    # Least recently used entries beyond the limit are dropped, or spilled to disk
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            if self.spill is not None:
+                self.spill[evicted_key] = evicted
+
+    def recognize(self, image: Image.Image, recognize: Callable[[Image.Image], Any]) -> Any:
+        key = self.key(image)
+        result = self.get(key)
+        if result is None:
+            result = recognize(image)
+            self.put(key, result)
+        return result
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "entries": len(self.entries)}
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
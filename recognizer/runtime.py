@@ -0,0 +1,260 @@
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import pickle
+import threading
+import time
+from concurrent.futures import Future
+from typing import *
+
+import numpy as np
+import torch
+from torch import nn
+
+from recognizer.data.input_format import model_input_format
+
+
+class RuntimeConfig(NamedTuple):
+    # Threads of a single operator, e.g. a convolution. None leaves the PyTorch default, one per core.
+    intra_op_threads: Optional[int] = None
+    # Threads running independent operators at once, which the sequential models here hardly have
+    inter_op_threads: Optional[int] = 1
+    # Cpus the process may run on, None for all
+    cpus: Optional[Set[int]] = None
+
+
+# Applies a runtime config to the calling process. Call before the first inference, the inter-op threads can only be set
+# once.
+def configure(config: RuntimeConfig):
+    if config.cpus:
+        os.sched_setaffinity(0, config.cpus)
+    if config.intra_op_threads:
+        torch.set_num_threads(config.intra_op_threads)
+    if config.inter_op_threads:
+        try:
+            torch.set_num_interop_threads(config.inter_op_threads)
+        except RuntimeError:
+            # Already set, or inter-op parallel work has already started
+            pass
+
+
+# Splits cpus into parts of nearly equal size, adjacent cpus staying together. With more parts than cpus, parts share
+# cpus.
+def split_cpus(cpus: Sequence[int], parts: int) -> List[Set[int]]:
+    cpus = sorted(cpus)
+    if parts > len(cpus):
+        return [{cpus[part % len(cpus)]} for part in range(parts)]
+    return [set(part.tolist()) for part in np.array_split(np.array(cpus), parts)]
+
+
+# Cpus given as e.g. 0-3,6
+def parse_cpus(cpus: str) -> Set[int]:
+    result = set()
+    for part in cpus.split(","):
+        begin, _, end = part.partition("-")
+        result.update(range(int(begin), int(end or begin) + 1))
+    return result
+
+
+# Handed to the caller, the replica keeps serving. Queues pickle in a thread of their own, where a failure would be
+# lost, so exceptions that cannot be pickled are replaced.
+def sendable(exception: Exception) -> Exception:
+    try:
+        pickle.dumps(exception)
+        return exception
+    except Exception:
+        return RuntimeError(repr(exception))
+
+
+def serve_replica(model: nn.Module, config: RuntimeConfig, requests, results,
+                  make_session: Optional[Callable[[nn.Module, Optional[int]], Any]] = None):
+    configure(config)
+    error = None
+    if make_session is not None:
+        try:
+            model = make_session(model, config.intra_op_threads)
+        except Exception as exception:
+            # Every request fails, rather than waiting for a replica that is gone
+            error = sendable(exception)
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        request_id, batch = request
+        if error is not None:
+            results.put((request_id, error))
+            continue
+        try:
+            with torch.no_grad():
+                output = model(batch)
+        except Exception as exception:
+            output = sendable(exception)
+        results.put((request_id, output))
+
+
+class ReplicaPool:
+    """Replicas of a model in processes of their own, each pinned to a part of the cpus, taking batches from one queue.
+
+    Replicas are forked from the process holding the model, so the weights are loaded once. Calling the pool with a
+    batch splits it between the replicas and returns the output of the model, so a pool is a drop-in replacement for
+    the model in recognizer.inference. Sessions, e.g. of recognizer.backends, do not survive a fork, as the thread pool
+    of onnxruntime does not, so they are built in every replica after the fork by make_session(model, threads).
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, model: nn.Module, replicas: int = 2, threads_per_replica: Optional[int] = None,
+                 cpus: Optional[Sequence[int]] = None,
+                 make_session: Optional[Callable[[nn.Module, Optional[int]], Any]] = None):
+        if not isinstance(model, nn.Module):
+            raise ValueError("Replicas are forked from a model, pass make_session to run it in a session")
+        self.hparams = getattr(model, 'hparams', {})
+        context = multiprocessing.get_context('fork')
+        cpus = sorted(cpus or os.sched_getaffinity(0))
+        parts = split_cpus(cpus, replicas)
+        model = model.cpu().eval()
+        # Shared, so forked replicas do not copy the weights as reference counts are updated
+        model.share_memory()
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(
+                target=serve_replica,
+                args=(model, RuntimeConfig(threads_per_replica or len(part), 1, part), self.requests, self.results,
+                      make_session),
+                daemon=True
+            )
+            for part in parts
+        ]
+        for process in self.processes:
+            process.start()
+
+        self.futures: Dict[int, Future] = {}
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            request_id, output = result
+            with self.lock:
+                future = self.futures.pop(request_id)
+            if isinstance(output, BaseException):
+                future.set_exception(output)
+            else:
+                future.set_result(output)
+
+    def submit(self, batch: torch.Tensor) -> Future:
+        future = Future()
+        request_id = next(self.request_ids)
+        with self.lock:
+            self.futures[request_id] = future
+        self.requests.put((request_id, batch.cpu()))
+        return future
+
+    def __call__(self, batch: torch.Tensor):
+        futures = [self.submit(chunk) for chunk in batch.chunk(len(self.processes))]
+        outputs = [future.result() for future in futures]
+        if isinstance(outputs[0], tuple):
+            return tuple(torch.cat(parts) for parts in zip(*outputs))
+        return torch.cat(outputs)
+
+    def close(self):
+        for _ in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+        with self.lock:
+            futures, self.futures = self.futures, {}
+        for future in futures.values():
+            future.set_exception(RuntimeError("The replica pool was closed"))
+
+
+# Clients send batches to the pool as fast as it answers them, the latency of a request includes its time in the queue
+def benchmark(pool: ReplicaPool, input_shape: Sequence[int], clients: int, requests: int, batch_size: int,
+              warmup: int = 2) -> Dict[str, float]:
+    batch = torch.rand(batch_size, *input_shape)
+    for _ in range(warmup * len(pool.processes)):
+        pool.submit(batch).result()
+
+    latencies = []
+    lock = threading.Lock()
+
+    def client(count: int):
+        for _ in range(count):
+            start = time.perf_counter()
+            pool.submit(batch).result()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(requests // clients,)) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "samples_per_second": len(latencies) * batch_size / seconds,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def parse_split(split: str) -> Tuple[int, int]:
+    replicas, threads = split.split("x")
+    return int(replicas), int(threads)
+
+
+if __name__ == '__main__':
+    from recognizer.model import KanjiRecognizer
+
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput and latency of splits of the cpus into model replicas and threads.")
+    parser.add_argument("-m", "--model-path", type=str, required=True, help="path to a checkpoint")
+    parser.add_argument("--splits", type=str, nargs="+", default=["1x8", "2x4", "4x2", "8x1"],
+                        help="replicas x threads per replica to measure (default: 1x8 2x4 4x2 8x1)")
+    parser.add_argument("--cpus", type=str, default=None, help="cpus to run the replicas on, e.g. 0-7 (default: all)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients (default: 8)")
+    parser.add_argument("--requests", type=int, default=400, help="requests per measurement (default: 400)")
+    parser.add_argument("--batch-size", type=int, default=1, help="crops per request (default: 1)")
+    parser.add_argument("--output", type=str, default="generated/benchmarks/runtime.jsonl",
+                        help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    model = KanjiRecognizer.load_from_checkpoint(args.model_path)
+    input_size, channels = model_input_format(model)
+    cpus = parse_cpus(args.cpus) if args.cpus else os.sched_getaffinity(0)
+    pathlib.Path(os.path.dirname(args.output)).mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+
+    for split in args.splits:
+        replicas, threads = parse_split(split)
+        pool = ReplicaPool(model, replicas, threads, cpus)
+        result = {
+            "timestamp": timestamp,
+            "model_path": args.model_path,
+            "replicas": replicas,
+            "threads_per_replica": threads,
+            "cpus": len(cpus),
+            "clients": args.clients,
+            "batch_size": args.batch_size,
+            **benchmark(pool, (channels, input_size, input_size), args.clients, args.requests, args.batch_size),
+        }
+        pool.close()
+        print(f"{replicas} replicas x {threads} threads: {result['samples_per_second']:.1f} samples/s, "
+              f"p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms")
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(result) + "\n")
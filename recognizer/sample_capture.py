@@ -0,0 +1,96 @@
+import queue
+import random
+import threading
+import traceback
+from typing import *
+
+import torch
+
+
+class SampleReservoir:
+    """A uniform random selection of the samples added since the last take, using reservoir sampling.
+
+    Meant to be filled from training_step with the batch and its predictions, so samples can be logged at the end of
+    the epoch without generating data or running the model again. Only selected samples are copied to the cpu.
+    """
+
+    def __init__(self, size: int = 8):
+        self.size = size
+        self.samples: List[Tuple[torch.Tensor, ...]] = []
+        self.seen = 0
+
+    def add(self, *batch: torch.Tensor):
+        slots = []
+        indices = []
+        for index in range(len(batch[0])):
+            self.seen += 1
+            if len(self.samples) + len(slots) < self.size:
+                slot = len(self.samples) + len(slots)
+            else:
+                slot = random.randrange(self.seen)
+                if slot >= self.size:
+                    continue
+            slots.append(slot)
+            indices.append(index)
+        if not indices:
+            return
+
+        selected = [tensor[indices].detach().cpu() for tensor in batch]
+        for i, slot in enumerate(slots):
+            sample = tuple(tensor[i] for tensor in selected)
+            if slot < len(self.samples):
+                self.samples[slot] = sample
+            else:
+                self.samples.append(sample)
+
+    def take(self) -> List[Tuple[torch.Tensor, ...]]:
+        samples = self.samples
+        self.samples = []
+        self.seen = 0
+        return samples
+
+
+class AsyncLogger:
+    """Runs logging calls on a background thread, so building and uploading images does not hold up training.
+
+    Calls are dropped rather than queued without limit if logging falls behind.
+    """
+
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = maxsize
+        self.calls = None
+        self.thread = None
+
+    # Copies, e.g. of a model for stochastic weight averaging, start their own thread when first used
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            function, args = call
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def submit(self, function: Callable, *args):
+        if self.thread is None:
+            self.calls = queue.Queue(maxsize=self.maxsize)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        try:
+            self.calls.put_nowait((function, args))
+        except queue.Full:
+            print(f"Logging is falling behind, dropped a call to {function.__name__}")
+
+    def close(self):
+        if self.thread is not None:
+            self.calls.put(None)
+            self.thread.join()
+            self.thread = None
@@ -1,7 +1,9 @@
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import WandbLogger
 
-from recognizer.data.data_module import RecognizerDataModule
+from recognizer.data.curriculum import Curriculum
+from recognizer.data.data_module import RecognizerDataModule, DataProfilingLogger
+from recognizer.data.hard_examples import HardExampleMining
 from recognizer.model import KanjiRecognizer
 
 if __name__ == "__main__":
@@ -12,7 +14,19 @@ if __name__ == "__main__":
         'character_set_name': 'top_100_kanji',
         'num_workers': 0,
         'model_type': 'resnet',
+        'classifier': 'flat',
+        'embedding_dim': 256,
+        # Samples are rendered at 128x128 and resized, e.g. 64 and 1 channel for a smaller grayscale model
+        'input_size': 128,
+        'channels': 3,
         'logger': True,
+        'profile_data': False,
+        'hard_example_mining': False,
+        # None, "local" or the host:port of a recognizer.data.generation_server on another machine
+        'generation_server': None,
+        'generation_processes': 4,
+        # Seed of the training samples, for runs seeing the same data. None gives different samples every run.
+        'seed': None,
         # 'logger': WandbLogger(entity="mb-haag-itu", log_model=True)
     }
 
@@ -24,7 +38,10 @@ if __name__ == "__main__":
         max_epochs=10,
         stochastic_weight_avg=True,
         logger=config['logger'],
-        auto_lr_find=True
+        auto_lr_find=True,
+        callbacks=[Curriculum()] +
+                  ([HardExampleMining()] if config['hard_example_mining'] else []) +
+                  ([DataProfilingLogger()] if config['profile_data'] else [])
     )
     tuner = trainer.tuner
     model = KanjiRecognizer(**config)
@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import queue
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+from PIL import Image
+
+from boxer.localize import region_scores, boxes_from_region_score, crop_around
+from boxer.model import KanjiBoxer
+from recognizer import backends, glyph_scale, inference, runtime
+from recognizer.model import KanjiRecognizer
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".webp"}
+DONE = object()
+
+
+class Frame(NamedTuple):
+    path: str
+    image: Image.Image
+    digest: str
+
+
+# Runs a generator in a background thread, handing its items over through a bounded queue, so a slow consumer
+# holds back the producer instead of letting it buffer without limit
+def threaded(items: Iterable, maxsize: int) -> Iterator:
+    handover = queue.Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            for item in items:
+                handover.put(item)
+        except BaseException as e:
+            handover.put(e)
+        handover.put(DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = handover.get()
+        if item is DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def frame_paths(folder: str) -> List[str]:
+    return sorted(str(path) for path in pathlib.Path(folder).iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def decode(path: str) -> Frame:
+    image = Image.open(path).convert('RGB')
+    return Frame(path, image, hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest())
+
+
+# Decodes frames in a thread pool, in order, with at most `maxsize` frames decoded ahead
+def decoded_frames(paths: List[str], workers: int, maxsize: int) -> Iterator[Frame]:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = queue.Queue(maxsize=maxsize)
+
+        def submit():
+            for path in paths:
+                pending.put(executor.submit(decode, path))
+            pending.put(DONE)
+
+        threading.Thread(target=submit, daemon=True).start()
+        while True:
+            future = pending.get()
+            if future is DONE:
+                return
+            yield future.result()
+
+
+# Marks frames that are identical to the previous frame, these are not localized or recognized again
+def changed_frames(frames: Iterable[Frame]) -> Iterator[Tuple[Frame, bool]]:
+    previous = None
+    for frame in frames:
+        yield frame, frame.digest != previous
+        previous = frame.digest
+
+
+def localized(boxer, frames: Iterable[Tuple[Frame, bool]]) -> Iterator[Tuple[Frame, bool, list]]:
+    for frame, changed in frames:
+        if not changed:
+            yield frame, changed, []
+            continue
+        region_score = region_scores(boxer, [frame.image])[0]
+        yield frame, changed, boxes_from_region_score(region_score)
+
+
+# With normalize_scale, the glyph in every box is rescaled to the canonical glyph size
+def crop_frame(image: Image.Image, boxes: List[Tuple[int, int, int, int]], normalize_scale: bool) -> List[Image.Image]:
+    if not normalize_scale:
+        return [crop_around(image, box) for box in boxes]
+    return glyph_scale.crop_boxes(image, [(x, y, x + w, y + h) for x, y, w, h in boxes])
+
+
+# Recognizes the crops of several frames per batch, emitting a record per frame in frame order
+def recognized(recognizer, characters, frames: Iterable[Tuple[Frame, bool, list]], batch_size: int, top: int,
+               normalize_scale: bool = True) -> Iterator[Dict[str, Any]]:
+    pending = []
+    crops = []
+    previous = None
+
+    def flush():
+        nonlocal previous
+        results = inference.top_k(recognizer, crops, characters, k=top) if crops else []
+        offset = 0
+        for frame, changed, boxes in pending:
+            if not changed:
+                yield {**previous, "frame": frame.path, "repeated": True}
+                continue
+            candidates = results[offset:offset + len(boxes)]
+            offset += len(boxes)
+            previous = {
+                "frame": frame.path,
+                "repeated": False,
+                "text": "".join(candidate[0] for candidate in candidates),
+                "characters": [{"box": box, "candidates": candidate} for box, candidate in zip(boxes, candidates)],
+            }
+            yield previous
+        pending.clear()
+        crops.clear()
+
+    for frame, changed, boxes in frames:
+        pending.append((frame, changed, boxes))
+        if boxes:
+            crops.extend(crop_frame(frame.image, boxes, normalize_scale))
+        if len(crops) >= batch_size or len(pending) >= batch_size:
+            yield from flush()
+    yield from flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recognize the text in a directory of video or subtitle frames.")
+    parser.add_argument("frames", type=str, help="folder of frames, read in file name order")
+    parser.add_argument("-b", "--boxer-path", type=str, required=True, help="path to a boxer checkpoint")
+    parser.add_argument("-m", "--model-path", type=str, required=True, help="path to a recognizer checkpoint")
+    parser.add_argument("-o", "--output", type=str, default="-",
+                        help="JSON lines file to write a record per frame to (default: stdout)")
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="maximum number of frames buffered between two stages (default: 16)")
+    parser.add_argument("--batch-size", type=int, default=64, help="crops per recognizer batch (default: 64)")
+    parser.add_argument("--top", type=int, default=5, help="candidates per character (default: 5)")
+    parser.add_argument("--keep-scale", action="store_true",
+                        help="crop around characters without rescaling them to the canonical glyph size")
+    parser.add_argument("--backend", type=str, default="torch", choices=backends.BACKENDS.keys(),
+                        help="inference backend of the boxer and recognizer (default: torch)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="threads per inference, or per replica with --replicas (default: one per cpu)")
+    parser.add_argument("--cpus", type=str, default=None, help="cpus to run inference on, e.g. 0-3 (default: all)")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="recognizer replicas each recognizing part of a batch on part of the cpus (default: 1)")
+    args = parser.parse_args()
+
+    cpus = runtime.parse_cpus(args.cpus) if args.cpus else None
+    runtime.configure(runtime.RuntimeConfig(args.threads, 1, cpus))
+
+    boxer = KanjiBoxer.load_from_checkpoint(args.boxer_path)
+    boxer.eval()
+    recognizer = KanjiRecognizer.load_from_checkpoint(args.model_path)
+    recognizer.eval()
+    character_set = recognizer.character_set
+    if args.replicas > 1:
+        make_session = None
+        if args.backend != "torch":
+            export_path = None
+            if args.backend == "onnxruntime":
+                # Exported once here, each replica only loads the file into a session of its own after the fork
+                export_path = os.path.join(tempfile.mkdtemp(), "recognizer.onnx")
+                backends.export_recognizer(recognizer, export_path)
+
+            def make_session(model, threads):
+                return backends.recognizer_session(model, backend=args.backend, threads=threads,
+                                                   export_path=export_path)
+        recognizer = runtime.ReplicaPool(recognizer, args.replicas, args.threads, cpus, make_session)
+    elif args.backend != "torch":
+        recognizer = backends.recognizer_session(recognizer, backend=args.backend, threads=args.threads)
+    # After forking the replicas, which must not inherit a session
+    if args.backend != "torch":
+        boxer = backends.boxer_session(boxer, backend=args.backend, threads=args.threads)
+
+    frames = decoded_frames(frame_paths(args.frames), args.decode_workers, args.queue_size)
+    frames = threaded(localized(boxer, changed_frames(frames)), args.queue_size)
+    records = recognized(
+        recognizer, character_set, frames, args.batch_size, args.top, normalize_scale=not args.keep_scale
+    )
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    with output:
+        for record in records:
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()